@@ -27,21 +27,15 @@ def getMosaicInfo(mosaic):
     products = mosaic['item_types']
     return (name, id, interval, products, bbox, self_link, quads_link, tiles_link)
 
-# adds important mosaic info to list of results
-def handle_page(page):
-    for item in page["mosaics"]:
-        results.append(getMosaicInfo(item))
-
 # pagination
-def fetch_page(search_url):
-    page = session.get(search_url).json()
-    handle_page(page)
-    next_url = page["_links"].get("_next")
-    if next_url:
-        fetch_page(next_url)
+# yields every page of results in turn, following the _next links one after another
+def iter_pages(search_url):
+    while search_url:
+        page = session.get(search_url).json()
+        yield page
+        search_url = page["_links"].get("_next")
 
-results = []
 search_url = res.json()['_links']['_self']
-fetch_page(search_url)
+results = (getMosaicInfo(item) for page in iter_pages(search_url) for item in page["mosaics"])
 titles = ['name', 'id', 'interval', 'products', 'bbox', 'self_link', 'quads_link', 'tiles_link']
 pandas.DataFrame(results, columns = titles).to_csv('all_mosaics.csv')
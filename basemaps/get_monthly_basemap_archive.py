@@ -6,6 +6,7 @@ geojson_path = './bounds/geojsons/UCNRS/Sedgwick_Reserve.geojson'
 
 import requests
 import os
+import sys
 import json
 import urllib.request
 import glob
@@ -14,6 +15,10 @@ import shutil
 import geopandas as gpd
 from rasterio.merge import merge
 
+# the instrumentation module lives with the scene scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scenes'))
+import instrumentation
+
 
 # authentication
 PLANET_API_KEY = os.getenv('PL_API_KEY')
@@ -36,23 +41,22 @@ string_bbox = get_string_bbox(geojson_path)
 # the basemaps and filter them on my own.
 res = session.get(API_URL, stream=True)
 
-# adds important mosaic info to list of results
-def handle_page(page):
-    for item in page["mosaics"]:
-        if 'ps_monthly_normalized_' in item['name']:
-            desiredBasemaps.append((item['name'], item['id'], item['bbox']))
-
 # pagination
-def fetch_page(search_url):
-    page = session.get(search_url).json()
-    handle_page(page)
-    next_url = page["_links"].get("_next")
-    if next_url:
-        fetch_page(next_url)
-
+# yields every page of results in turn, following the _next links one after another
+def iter_pages(search_url):
+    while search_url:
+        with instrumentation.span('api_request', endpoint='mosaics page'):
+            page = session.get(search_url).json()
+        yield page
+        search_url = page["_links"].get("_next")
+
+# keeps important mosaic info for the monthly basemaps
 desiredBasemaps = []
 search_url = res.json()['_links']['_self']
-fetch_page(search_url)
+for page in iter_pages(search_url):
+    for item in page["mosaics"]:
+        if 'ps_monthly_normalized_' in item['name']:
+            desiredBasemaps.append((item['name'], item['id'], item['bbox']))
 
 
 
@@ -60,7 +64,8 @@ fetch_page(search_url)
 def downloadQuads(mosaic_id, bbox, output_prefix):
     search_parameters = {'bbox': bbox, 'minimal': True}
     quads_url = "{}/{}/quads".format("https://api.planet.com/basemaps/v1/mosaics", mosaic_id)
-    quads_request = session.get(quads_url, params=search_parameters, stream=True)
+    with instrumentation.span('api_request', endpoint='quads', mosaic=mosaic_id):
+        quads_request = session.get(quads_url, params=search_parameters, stream=True)
     print(quads_request)
     quads = quads_request.json()['items']
     if not os.path.exists(output_prefix + '_quads'):
@@ -73,15 +78,19 @@ def downloadQuads(mosaic_id, bbox, output_prefix):
         filename = os.path.join(DIR, name)
         #checks if file already exists before downloading
         if not os.path.isfile(filename):
-            urllib.request.urlretrieve(link, filename)
+            with instrumentation.span('download', file=name) as s:
+                urllib.request.urlretrieve(link, filename)
+                s['bytes'] = os.path.getsize(filename)
 
 
 # takes every tiff file in a directory and mosaics them together into a new tiff file
 def make_mosaic(directory, output_name):
     tif_files = glob.glob(os.path.join(directory, "*.tiff"))
     # if len(tif_files )
-    datasets = [rasterio.open(file) for file in tif_files]
-    mosaic, mosaic_transform = merge(datasets)
+    with instrumentation.span('raster_open', files=len(tif_files)):
+        datasets = [rasterio.open(file) for file in tif_files]
+    with instrumentation.span('merge'):
+        mosaic, mosaic_transform = merge(datasets)
     mosaic_dataset = rasterio.open(
         output_name + '.tiff',
         "w",
@@ -93,7 +102,8 @@ def make_mosaic(directory, output_name):
         crs=datasets[0].crs,
         transform=mosaic_transform,
     )
-    mosaic_dataset.write(mosaic)
+    with instrumentation.span('write', file=os.path.basename(output_name) + '.tiff'):
+        mosaic_dataset.write(mosaic)
 
 
 for name, id, bbox in desiredBasemaps:
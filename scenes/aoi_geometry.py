@@ -0,0 +1,107 @@
+### Prepares an AOI GeoJSON for use in a Planet API request
+### Every feature in the file gets merged into one (Multi)Polygon, holes included. If that has more vertices or takes up
+### more bytes than the API accepts, it gets simplified once, up front, to the least-simplified version that fits, instead
+### of finding out from a 413 and trying again. The simplified AOI always covers the whole original AOI, so a search
+### with it can only ever return extra scenes, never miss any.
+### Used by search_scenes.py
+
+
+
+# Import packages
+import hashlib
+import json
+import os
+from shapely.geometry import mapping, shape
+from shapely.ops import unary_union
+
+
+# Simplified AOIs already worked out during this run, by cache key
+aoi_cache = {}
+
+
+# Reads every feature of a GeoJSON into one valid (Multi)Polygon
+def load_aoi(aoi_path):
+    with open(aoi_path) as f:
+        geojson = json.load(f)
+    features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+    geometry = unary_union([shape(feature['geometry'] if 'geometry' in feature else feature) for feature in features])
+    if not geometry.is_valid:
+        geometry = geometry.buffer(0)
+    return geometry
+
+
+def count_vertices(geometry):
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    return sum(len(polygon.exterior.coords) + sum(len(ring.coords) for ring in polygon.interiors) for polygon in polygons)
+
+
+def get_size_bytes(geometry):
+    return len(json.dumps(mapping(geometry)))
+
+
+def fits_budget(geometry, max_vertices, max_bytes):
+    return count_vertices(geometry) <= max_vertices and get_size_bytes(geometry) <= max_bytes
+
+
+# Simplifies a geometry by tolerance (in the geometry's units) without changing its topology, then grows it back out by
+# however far the simplified outline ended up from the original (usually about the tolerance, but keeping the topology
+# can push it a bit further), so the grown-out version covers the original. Mitred corners keep the buffer from adding
+# any rounded-corner vertices.
+def get_covering_simplification(geometry, tolerance):
+    if tolerance == 0:
+        return geometry
+    simplified = geometry.simplify(tolerance, preserve_topology=True)
+    return simplified.buffer(simplified.hausdorff_distance(geometry) * 1.01, join_style=2)
+
+
+# Finds the smallest simplification tolerance whose covering simplification fits the budget, by bisection
+# Falls back to the convex hull if even simplifying to the size of the whole AOI doesn't fit (e.g. hundreds of islands)
+def simplify_to_budget(geometry, max_vertices, max_bytes):
+    if fits_budget(geometry, max_vertices, max_bytes):
+        return geometry
+    left, bottom, right, top = geometry.bounds
+    low = 0
+    high = max(right - left, top - bottom)
+    if not fits_budget(get_covering_simplification(geometry, high), max_vertices, max_bytes):
+        return geometry.convex_hull
+    for i in range(30):
+        middle = (low + high) / 2
+        if fits_budget(get_covering_simplification(geometry, middle), max_vertices, max_bytes):
+            high = middle
+        else:
+            low = middle
+    simplified = get_covering_simplification(geometry, high)
+    return simplified if simplified.covers(geometry) else geometry.convex_hull
+
+
+# Gets an AOI file's geometry, simplified to fit the budget, as a GeoJSON geometry dict ready to go in a request
+# The result gets cached in memory and, if cache_directory is given, on disk; the cache key covers the file's contents
+# and the budget, so editing the AOI or changing the budget makes a new one
+def prepare_aoi(aoi_path, max_vertices, max_bytes, cache_directory=None):
+    with open(aoi_path, 'rb') as f:
+        contents = f.read()
+    cache_key = hashlib.sha1(contents + json.dumps([max_vertices, max_bytes]).encode()).hexdigest()[:16]
+    if cache_key in aoi_cache:
+        return aoi_cache[cache_key]
+
+    cache_path = None
+    if cache_directory is not None:
+        cache_path = os.path.join(cache_directory, os.path.splitext(os.path.basename(aoi_path))[0] + '_' + cache_key + '.geojson')
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                aoi_cache[cache_key] = json.load(f)
+            return aoi_cache[cache_key]
+
+    geometry = load_aoi(aoi_path)
+    simplified = simplify_to_budget(geometry, max_vertices, max_bytes)
+    if simplified is not geometry:
+        print('Simplified ' + os.path.basename(aoi_path) + ' from ' + str(count_vertices(geometry)) + ' to ' + str(count_vertices(simplified)) + ' vertices to fit in an API request.')
+    aoi_cache[cache_key] = mapping(simplified)
+
+    if cache_path is not None:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory, exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as outfile:
+            json.dump(aoi_cache[cache_key], outfile)
+        os.replace(cache_path + '.tmp', cache_path)
+    return aoi_cache[cache_key]
@@ -0,0 +1,154 @@
+### Band math for derived products
+### Each index is defined once as an expression over named bands, and gets compiled into a single fused evaluator
+### Used by make_derived_products.py
+
+
+
+# Import packages
+import ast
+import numpy as np
+
+# numexpr is optional; if it's installed it evaluates whole expressions in cache-sized chunks without any full-size temporaries
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+
+# Which band of a PlanetScope 4-band mosaic each band name refers to
+band_numbers = {
+    'B': 1,
+    'G': 2,
+    'R': 3,
+    'NIR': 4,
+}
+
+
+#### Index registry ####
+#### Adding a new index only takes a new line here. Expressions can use the band names above, numbers, + - * / **, and sqrt()
+#### All equations were taken from Planet's developer tool website: https://developers.planet.com/docs/basemaps/tile-services/indices/#remote-sensing-indices-legends"
+indices = {
+    'ndvi': '(NIR - R) / (NIR + R)',                                                            # Normalized Difference Vegetation Index
+    'ndwi': '(G - NIR) / (G + NIR)',                                                            # Normalized Difference Water Index (green/NIR version, NOT the SWIR version)
+    'msavi2': '(2*NIR + 1 - ((2*NIR + 1)**2 - 8*(NIR - R))**0.5) / 2',                          # Modified Soil Adjusted Vegetation Index 2
+    'mtvi2': '1.5 * (1.2 * (NIR - G) - 2.5 * (R - G)) / (((2*NIR+1)**2 - (6*NIR-5*(R)**0.5))**0.5-0.5)', # Modified Triangular Vegetation Index 2
+    'vari': '(G - R) / (G + R - B)',                                                            # Visible Atmospherically Resistant Index
+    'tgi': '(120*(R-B)-(190*(R-G))) / (2)',                                                     # Triangular Greenness Index
+    'evi': '2.5 * (NIR - R) / (NIR + 6*R - 7.5*B + 1)',                                         # Enhanced Vegetation Index
+    'savi': '1.5 * (NIR - R) / (NIR + R + 0.5)',                                                # Soil Adjusted Vegetation Index (L = 0.5)
+}
+
+
+
+# numpy functions for each piece of syntax an expression is allowed to use
+binary_ufuncs = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+function_ufuncs = {
+    'sqrt': np.sqrt,
+    'abs': np.abs,
+}
+
+
+# Turns an expression into a list of steps, where each step is a single numpy ufunc call
+# Subexpressions that show up more than once (like 2*NIR + 1 in MSAVI2) are only turned into one step
+# Each step is (ufunc, args), and each arg is one of ('band', name), ('const', value), or ('step', step number)
+# Returns the list of steps and the operand holding the final result
+def plan_expression(expression):
+    tree = ast.parse(expression, mode='eval').body
+    steps = []
+    seen = {}       # ast.dump() of a subexpression -> operand holding its result
+
+    def add_step(ufunc, args):
+        # Anything made only of constants gets worked out right now instead of once per pixel
+        if all(arg[0] == 'const' for arg in args):
+            return ('const', float(ufunc(*[arg[1] for arg in args])))
+        # x**0.5 and x**2 have much faster ufuncs of their own
+        if ufunc is np.power and args[1] == ('const', 0.5):
+            ufunc, args = np.sqrt, args[:1]
+        elif ufunc is np.power and args[1] == ('const', 2.0):
+            ufunc, args = np.square, args[:1]
+        steps.append((ufunc, args))
+        return ('step', len(steps) - 1)
+
+    def visit(node):
+        key = ast.dump(node)
+        if key in seen:
+            return seen[key]
+        if isinstance(node, ast.Name) and node.id in band_numbers:
+            operand = ('band', node.id)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            operand = ('const', float(node.value))
+        elif isinstance(node, ast.BinOp) and type(node.op) in binary_ufuncs:
+            operand = add_step(binary_ufuncs[type(node.op)], [visit(node.left), visit(node.right)])
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = add_step(np.negative, [visit(node.operand)])
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            operand = visit(node.operand)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in function_ufuncs and len(node.args) == 1:
+            operand = add_step(function_ufuncs[node.func.id], [visit(node.args[0])])
+        else:
+            raise ValueError('Unsupported syntax in band math expression: ' + expression)
+        seen[key] = operand
+        return operand
+
+    output = visit(tree)
+    return steps, output
+
+
+# Compiles an expression into a function that takes a dict of band name -> numpy array and returns the result
+# With numexpr installed the whole expression is evaluated in one fused pass; otherwise each step of the plan runs
+# as a numpy ufunc, and a temporary is overwritten in place as soon as nothing later needs it, so only a couple of
+# full-size temporaries are ever alive at once
+def compile_expression(expression, use_numexpr=True):
+    steps, output = plan_expression(expression)     # also checks that the expression only uses syntax we support
+
+    if use_numexpr and numexpr is not None:
+        def evaluate_numexpr(bands):
+            return numexpr.evaluate(expression, local_dict=dict(bands))
+        return evaluate_numexpr
+
+    # Step number of the last step that needs each step's result
+    last_use = {}
+    for step_number, (ufunc, args) in enumerate(steps):
+        for arg in args:
+            if arg[0] == 'step':
+                last_use[arg[1]] = step_number
+
+    def evaluate_numpy(bands):
+        results = {}
+
+        def get_value(arg):
+            if arg[0] == 'band':
+                return bands[arg[1]]
+            if arg[0] == 'const':
+                return arg[1]
+            return results[arg[1]]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for step_number, (ufunc, args) in enumerate(steps):
+                values = [get_value(arg) for arg in args]
+                # Reuse the memory of a temporary that isn't needed after this step
+                out = None
+                for arg in args:
+                    if arg[0] == 'step' and last_use[arg[1]] == step_number and results[arg[1]].dtype.kind == 'f':
+                        out = results[arg[1]]
+                        break
+                results[step_number] = ufunc(*values, out=out) if out is not None else ufunc(*values)
+                # Drop any temporaries this was the last user of
+                for arg in args:
+                    if arg[0] == 'step' and last_use[arg[1]] == step_number and arg[1] in results:
+                        del results[arg[1]]
+
+        if output[0] == 'band':
+            return np.array(bands[output[1]], dtype='float64')
+        if output[0] == 'const':
+            return np.full(np.shape(next(iter(bands.values()))), output[1])
+        return results[output[1]]
+
+    return evaluate_numpy
@@ -0,0 +1,214 @@
+### Benchmarks the L1 -> L2 -> L3 raster pipeline on synthetic data
+### Makes fake 4-band SR scenes and UDM2s (in two UTM zones, like real scenes near Sedgwick), then times mosaicking
+### and index generation. Wall time, peak RSS and bytes read/written for each stage get saved to a JSON file so that
+### results can be compared between versions. Runs offline; the RSS and I/O numbers need Linux.
+###
+### Example: python benchmark_pipeline.py --scenes 6 --height 4000 --width 8000 --output results.json
+
+
+
+# Import packages
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+from queue import Empty
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform as transform_coords
+
+
+# AOI is centred on Sedgwick Reserve, which sits right on the boundary between UTM zones 10 and 11
+aoi_center = (-120.05, 34.71)
+aoi_size_degrees = 0.06
+scene_epsgs = [32610, 32611]
+date = '20230628'
+
+
+# Writes a square AOI as a GeoJSON in EPSG:4326
+def make_aoi(aoi_path):
+    lon, lat = aoi_center
+    half = aoi_size_degrees / 2
+    ring = [[lon - half, lat - half], [lon + half, lat - half], [lon + half, lat + half], [lon - half, lat + half], [lon - half, lat - half]]
+    aoi = {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]}
+    with open(aoi_path, 'w') as outfile:
+        json.dump(aoi, outfile)
+
+
+# Writes one synthetic scene (4-band uint16 SR, like Planet's analytic_sr) and its 8-band UDM2 to the imagery directory
+# Scenes alternate between UTM zones and get shifted around the AOI so they overlap each other by different amounts
+def make_scene(imagery_directory, scene_number, height, width, rng):
+    epsg = scene_epsgs[scene_number % len(scene_epsgs)]
+    offset_lon, offset_lat = rng.uniform(-0.02, 0.02, size=2)
+    x, y = transform_coords('EPSG:4326', 'EPSG:' + str(epsg), [aoi_center[0] + offset_lon], [aoi_center[1] + offset_lat])
+    transform = from_origin(x[0] - width * 3 / 2, y[0] + height * 3 / 2, 3, 3)
+    scene_id = date + '_' + str(180000 + scene_number) + '_' + str(10 + scene_number) + '_24a4'
+    profile = {'driver': 'GTiff', 'height': height, 'width': width, 'crs': 'EPSG:' + str(epsg), 'transform': transform, 'compress': 'lzw', 'tiled': True}
+
+    # Smooth-ish reflectance so compression behaves more like real imagery than pure noise would
+    base = rng.integers(300, 3000, size=(4, height // 64 + 1, width // 64 + 1)).astype('uint16')
+    sr = np.repeat(np.repeat(base, 64, axis=1), 64, axis=2)[:, :height, :width]
+    sr = sr + rng.integers(0, 50, size=sr.shape, dtype='uint16')
+    with rasterio.open(os.path.join(imagery_directory, scene_id + '_3B_AnalyticMS_SR_harmonized_clip.tif'), 'w', count=4, dtype='uint16', nodata=0, **profile) as dst:
+        dst.write(sr)
+
+    # UDM2: band 1 is clear, bands 2-6 are snow/shadow/light haze/heavy haze/cloud, band 7 is confidence, band 8 unusable
+    cloudy = np.repeat(np.repeat(rng.random((height // 256 + 1, width // 256 + 1)) < 0.15, 256, axis=0), 256, axis=1)[:height, :width]
+    udm = np.zeros((8, height, width), dtype='uint8')
+    udm[0] = ~cloudy
+    udm[5] = cloudy
+    udm[6] = np.where(cloudy, 60, 90)
+    with rasterio.open(os.path.join(imagery_directory, scene_id + '_3B_udm2_clip.tif'), 'w', count=8, dtype='uint8', **profile) as dst:
+        dst.write(udm)
+
+
+# Makes the synthetic inputs for a benchmark run
+def make_inputs(workdir, num_scenes, height, width, seed):
+    rng = np.random.default_rng(seed)
+    imagery_directory = os.path.join(workdir, 'L1')
+    os.makedirs(imagery_directory)
+    for scene_number in range(num_scenes):
+        make_scene(imagery_directory, scene_number, height, width, rng)
+    make_aoi(os.path.join(workdir, 'aoi.geojson'))
+
+
+# Bytes read/written by this process so far (all reads and writes, including ones served from the page cache)
+def get_io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        return None, None
+
+
+#### Stages ####
+#### Each stage runs in its own fresh process so that peak RSS only counts that stage
+
+def stage_mosaic(workdir):
+    import geopandas as gpd
+    import make_mosaic
+    imagery_directory = os.path.join(workdir, 'L1')
+    make_mosaic.imagery_directory = imagery_directory
+    os.makedirs(os.path.join(workdir, 'L2'), exist_ok=True)
+    scenes = sorted([os.path.join(imagery_directory, file) for file in os.listdir(imagery_directory) if file.endswith('harmonized_clip.tif')])
+    gdf = gpd.read_file(os.path.join(workdir, 'aoi.geojson'))
+    make_mosaic.make_mosaic(scenes, os.path.join(workdir, 'L2', date + '.tif'), make_mosaic.dst_epsg, gdf)
+
+
+def run_indices(workdir, streaming):
+    import make_derived_products
+    output_directory = os.path.join(workdir, 'L3_streaming' if streaming else 'L3')
+    make_derived_products.mosaic_directory = os.path.join(workdir, 'L2')
+    make_derived_products.indices_directory = output_directory
+    make_derived_products.streaming = streaming
+    for index in make_derived_products.enabled_indices:
+        os.makedirs(os.path.join(output_directory, index), exist_ok=True)
+    make_derived_products.make_indices(date + '.tif', make_derived_products.enabled_indices)
+
+
+def stage_indices(workdir):
+    run_indices(workdir, False)
+
+
+def stage_indices_streaming(workdir):
+    run_indices(workdir, True)
+
+
+stages = {
+    'mosaic': stage_mosaic,
+    'indices': stage_indices,
+    'indices_streaming': stage_indices_streaming,
+}
+
+
+# Runs one stage and sends its measurements back to the parent process
+def run_stage(stage, workdir, queue):
+    try:
+        read_before, written_before = get_io_bytes()
+        start = time.perf_counter()
+        stages[stage](workdir)
+        wall_seconds = time.perf_counter() - start
+        read_after, written_after = get_io_bytes()
+        queue.put({
+            'wall_seconds': wall_seconds,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,     # ru_maxrss is in KB on Linux
+            'bytes_read': None if read_before is None else read_after - read_before,
+            'bytes_written': None if written_before is None else written_after - written_before,
+        })
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+# Waits for a stage's result from its process. A process that dies without sending one (e.g. killed by the OOM killer,
+# a signal or a crash in GDAL) gets recorded with its exit code instead of leaving the benchmark waiting forever.
+def get_stage_result(process, queue):
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                break
+    # the process may have sent its result just before exiting
+    try:
+        return queue.get(timeout=1)
+    except Empty:
+        return {'error': 'exit code ' + str(process.exitcode)}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks mosaicking and index generation on synthetic PlanetScope data')
+    parser.add_argument('--scenes', type=int, default=6, help='number of scenes in the synthetic date')
+    parser.add_argument('--height', type=int, default=4000, help='height of each scene in pixels (a real PlanetScope scene is about 4000-5000)')
+    parser.add_argument('--width', type=int, default=8000, help='width of each scene in pixels (a real PlanetScope scene is about 8000-9000)')
+    parser.add_argument('--stages', nargs='+', default=list(stages), choices=list(stages), help='stages to run, in order')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data')
+    parser.add_argument('--workdir', default=None, help='directory to put synthetic data in (default: a temporary directory that gets deleted)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to save results to')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='planet_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'git_commit': get_git_commit(),
+        'parameters': {'scenes': args.scenes, 'height': args.height, 'width': args.width, 'seed': args.seed},
+        'stages': {},
+    }
+    try:
+        print(str(datetime.datetime.now().time()) + '    Making ' + str(args.scenes) + ' synthetic ' + str(args.height) + 'x' + str(args.width) + ' scenes...')
+        if not os.path.exists(os.path.join(workdir, 'L1')):
+            make_inputs(workdir, args.scenes, args.height, args.width, args.seed)
+
+        context = multiprocessing.get_context('spawn')
+        for stage in args.stages:
+            print(str(datetime.datetime.now().time()) + '    Running ' + stage + '...')
+            queue = context.Queue()
+            process = context.Process(target=run_stage, args=(stage, workdir, queue))
+            process.start()
+            result = get_stage_result(process, queue)
+            process.join()
+            results['stages'][stage] = result
+            print(str(datetime.datetime.now().time()) + '    ' + stage + ': ' + json.dumps(result))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print('Results saved to ' + args.output)
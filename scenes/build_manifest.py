@@ -0,0 +1,86 @@
+### Keeps track of which inputs (and which version of the processing) each output was built from
+### so that reruns only have to rebuild outputs that are actually out of date
+### Used by make_derived_products.py
+
+
+
+# Import packages
+import hashlib
+import json
+import os
+
+
+# Loads a manifest from disk; a missing manifest is just an empty one
+# Manifests look like {'outputs': {output key: {'definition': ..., 'inputs': [file signature, ...]}}}
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {'outputs': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+# Saves a manifest to disk; written to a temporary file first so an interrupted save never corrupts it
+def save_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+# Hashes anything JSON-serializable (e.g. an index expression plus its output profile) into a short version string
+# Changing any part of the definition changes the version, which marks every output made with it as out of date
+def get_definition_version(definition):
+    return hashlib.sha1(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+# Hashes a file's contents, reading it a chunk at a time
+def get_content_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024**2), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Gets the signature of an input file: its path, size and modification time, plus a content hash if asked for
+# previous: the signature recorded for this file last time; its hash gets reused if the size and mtime haven't changed,
+# so files only ever get hashed after they've been touched
+def get_file_signature(file_path, use_content_hash=False, previous=None):
+    stat = os.stat(file_path)
+    signature = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if use_content_hash:
+        if previous is not None and previous.get('sha256') and previous['size'] == signature['size'] and previous['mtime'] == signature['mtime']:
+            signature['sha256'] = previous['sha256']
+        else:
+            signature['sha256'] = get_content_hash(file_path)
+    return signature
+
+
+# Gets the signatures recorded last time for an output's inputs (None for each input that wasn't recorded)
+def get_previous_signatures(manifest, output_key, input_paths):
+    record = manifest['outputs'].get(output_key)
+    recorded = {} if record is None else {signature['path']: signature for signature in record['inputs']}
+    return [recorded.get(os.path.abspath(path)) for path in input_paths]
+
+
+# Checks whether an output is up to date: it has to exist, have been made with the same definition version,
+# and have been made from inputs with the same signatures (content hash if we have one, otherwise size + mtime)
+def is_up_to_date(manifest, output_key, output_path, input_signatures, definition_version):
+    record = manifest['outputs'].get(output_key)
+    if record is None or not os.path.exists(output_path):
+        return False
+    if record['definition'] != definition_version or len(record['inputs']) != len(input_signatures):
+        return False
+    for recorded, current in zip(record['inputs'], input_signatures):
+        if recorded['path'] != current['path'] or recorded['size'] != current['size']:
+            return False
+        if 'sha256' in current and 'sha256' in recorded:
+            if recorded['sha256'] != current['sha256']:
+                return False
+        elif recorded['mtime'] != current['mtime']:
+            return False
+    return True
+
+
+# Records that an output was built from the given inputs with the given definition version
+def record_output(manifest, output_key, input_signatures, definition_version):
+    manifest['outputs'][output_key] = {'definition': definition_version, 'inputs': input_signatures}
@@ -0,0 +1,138 @@
+### Appends L3 index rasters into a chunked, compressed time-series datacube (Zarr)
+### The cube is time x y x x with one variable per index, all on one fixed grid, so a pixel's full history is one read
+### Needs xarray and zarr 3 or newer (the cube gets written in Zarr format 3)
+### Used by make_derived_products.py
+
+
+
+# Import packages
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xa
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from zarr.codecs import BloscCodec
+
+
+# Gets the grid (CRS, transform and shape) of a raster; the first raster put in a cube sets the grid for the whole cube
+def get_raster_grid(raster_path):
+    with rasterio.open(raster_path) as src:
+        return {'crs': src.crs.to_wkt(), 'transform': list(src.transform)[:6], 'height': src.height, 'width': src.width}
+
+
+# Gets the grid of an existing cube from its attributes
+def get_cube_grid(cube):
+    return {'crs': cube.attrs['crs'], 'transform': cube.attrs['transform'], 'height': cube.sizes['y'], 'width': cube.sizes['x']}
+
+
+# Reads a single-band raster onto the cube's grid as float32 with NaN for nodata
+# Rasters already on the grid are read directly; anything else (e.g. a mosaic with a different extent) gets warped onto it
+def read_onto_grid(raster_path, grid):
+    transform = Affine(*grid['transform'])
+    with rasterio.open(raster_path) as src:
+        if src.crs.to_wkt() == grid['crs'] and src.transform == transform and src.shape == (grid['height'], grid['width']):
+            data = src.read(1, masked=True)
+        else:
+            with WarpedVRT(src, crs=grid['crs'], transform=transform, height=grid['height'], width=grid['width'], resampling=Resampling.nearest) as vrt:
+                data = vrt.read(1, masked=True)
+        return data.astype('float32').filled(np.nan) * np.float32(src.scales[0]) + np.float32(src.offsets[0])
+
+
+# Builds a one-date slice of the cube
+# date: date string from the mosaic name, e.g. '20230628'
+# raster_paths: dict of index name -> path to that index's raster for this date
+# variables: every variable in the cube; any the date doesn't have get filled with NaN
+def make_date_slice(date, raster_paths, variables, grid):
+    transform = Affine(*grid['transform'])
+    x = transform.c + (np.arange(grid['width']) + 0.5) * transform.a
+    y = transform.f + (np.arange(grid['height']) + 0.5) * transform.e
+    data_vars = {}
+    for variable in variables:
+        if variable in raster_paths:
+            data = read_onto_grid(raster_paths[variable], grid)
+        else:
+            data = np.full((grid['height'], grid['width']), np.nan, dtype='float32')
+        data_vars[variable] = (('time', 'y', 'x'), data[np.newaxis, :, :])
+    return xa.Dataset(data_vars, coords={'time': [pd.Timestamp(date)], 'y': y, 'x': x})
+
+
+# Appends any dates that aren't already in the cube, creating the cube if it doesn't exist yet
+# dates: dict of date string -> {index name: raster path}
+# chunks: (time, y, x) chunk shape; the default suits both reading a whole map and reading a pixel's time series
+# rebuilt_dates: date strings whose rasters were remade since they went into the cube; these get rewritten in place
+# Dates get written in batches that line up with the time chunks, so appending only ever rewrites the last partly
+# filled time chunk and never touches any of the full chunks that are already in the cube
+def append_dates(cube_path, dates, chunks=(16, 256, 256), rebuilt_dates=()):
+    if os.path.exists(cube_path):
+        with xa.open_zarr(cube_path) as cube:
+            grid = get_cube_grid(cube)
+            variables = list(cube.data_vars)
+            cube_times = list(pd.to_datetime(cube.time.values))
+            existing_dates = set(cube_times)
+            last_date = max(existing_dates) if existing_dates else None
+            num_existing = cube.sizes['time']
+    else:
+        first_date = sorted(dates)[0]
+        grid = get_raster_grid(next(iter(dates[first_date].values())))
+        variables = sorted(set(index for raster_paths in dates.values() for index in raster_paths))
+        cube_times = []
+        existing_dates = set()
+        last_date = None
+        num_existing = 0
+
+    new_dates = sorted(date for date in dates if pd.Timestamp(date) not in existing_dates)
+    stale_dates = sorted(date for date in set(rebuilt_dates) if date in dates and pd.Timestamp(date) in existing_dates)
+    if len(new_dates) == 0 and len(stale_dates) == 0:
+        print('Datacube is already up to date.')
+        return
+    extra_variables = set(index for date in new_dates + stale_dates for index in dates[date]) - set(variables)
+    if extra_variables:
+        print('Datacube has no variable for ' + ', '.join(sorted(extra_variables)) + '; these indices will not be added to it.')
+    if last_date is not None and len(new_dates) > 0 and pd.Timestamp(new_dates[0]) < last_date:
+        print('Some new dates are older than the newest date in the datacube; sort by time after opening it.')
+
+    # Dates already in the cube whose rasters were remade get their time slice overwritten where it is
+    if len(stale_dates) > 0:
+        print('Rewriting ' + str(len(stale_dates)) + ' dates in the datacube whose indices were rebuilt...')
+    for date in stale_dates:
+        position = cube_times.index(pd.Timestamp(date))
+        # A region write can only hold variables along the region's dimension, so the y and x coordinates get left out
+        date_slice = make_date_slice(date, dates[date], variables, grid).drop_vars(['y', 'x'])
+        date_slice.attrs['crs'] = grid['crs']
+        date_slice.attrs['transform'] = grid['transform']
+        date_slice.to_zarr(cube_path, region={'time': slice(position, position + 1)}, zarr_format=3, consolidated=True)
+    if len(new_dates) == 0:
+        return
+
+    print('Appending ' + str(len(new_dates)) + ' dates to datacube at ' + cube_path + '...')
+    time_chunk = chunks[0]
+    start = 0
+    while start < len(new_dates):
+        batch_size = time_chunk - (num_existing % time_chunk)
+        batch = new_dates[start:start + batch_size]
+        batch_slices = xa.concat([make_date_slice(date, dates[date], variables, grid) for date in batch], dim='time')
+        # Every write replaces the cube's attributes with the batch's, so each batch has to carry the grid
+        batch_slices.attrs['crs'] = grid['crs']
+        batch_slices.attrs['transform'] = grid['transform']
+        if num_existing == 0:
+            # The first batch creates the cube under a temporary name and only gets moved into place once it's written,
+            # so a failed first write can't leave a half-made cube behind for every later run to trip over
+            temp_path = cube_path + '.tmp'
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+            compressors = (BloscCodec(cname='zstd', clevel=5, shuffle='bitshuffle'),)
+            encoding = {variable: {'chunks': chunks, 'compressors': compressors, 'dtype': 'float32'} for variable in variables}
+            try:
+                batch_slices.to_zarr(temp_path, mode='w-', encoding=encoding, zarr_format=3, consolidated=True)
+            except:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+            os.replace(temp_path, cube_path)
+        else:
+            batch_slices.to_zarr(cube_path, append_dim='time', zarr_format=3, consolidated=True)
+        num_existing += len(batch)
+        start += len(batch)
@@ -0,0 +1,177 @@
+### Stage-level timing and I/O instrumentation for the pipeline scripts
+### Scripts wrap each stage (an API request, an order poll, a download, a raster read, a warp, a write...) in a span:
+###
+###     with instrumentation.span('download', file=filename) as s:
+###         ...
+###         s['bytes'] = len(r.content)
+###
+### Each span records wall time, CPU time and bytes read/written by the process, plus any fields the script adds. Bytes
+### per second gets worked out for spans that set 'bytes'. Everything is off unless turned on with environment variables,
+### so the scripts run the same as always by default:
+###
+###     PIPELINE_TRACE=trace.jsonl     append every span to this file as one JSON object per line
+###     PIPELINE_SUMMARY=1             print a table of time per stage when the script exits
+###     PIPELINE_PROFILE=cprofile      profile the main process with cProfile (saved as <script>_<pid>.prof in the
+###                                    working directory, with the top functions printed at exit)
+###     PIPELINE_PROFILE=py-spy        sample the whole run (and its worker processes) with py-spy, saved as
+###                                    <script>_<pid>.svg; py-spy has to be installed and on the PATH
+###
+### Worker processes inherit the settings and write to the same trace file, and every line carries the run's ID, so the
+### summary at exit covers the workers too when a trace file is being written.
+### Used by search_scenes.py, order_list_of_scenes.py, make_mosaic.py, make_derived_products.py and
+### ../basemaps/get_monthly_basemap_archive.py
+
+
+
+# Import packages
+import atexit
+import contextlib
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+trace_path = os.environ.get('PIPELINE_TRACE')
+summary = os.environ.get('PIPELINE_SUMMARY', '') not in ('', '0')
+profile = os.environ.get('PIPELINE_PROFILE')
+
+# Processes started by this one (e.g. worker processes) inherit the run ID, so their spans can be told apart from other runs
+is_main_process = 'PIPELINE_RUN_ID' not in os.environ
+if is_main_process:
+    os.environ['PIPELINE_RUN_ID'] = datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '_' + str(os.getpid())
+run_id = os.environ['PIPELINE_RUN_ID']
+script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+# Spans recorded by this process, for the summary when there's no trace file to read back
+totals = {}
+
+
+def is_enabled():
+    return trace_path is not None or summary
+
+
+# Bytes read/written by this process so far (all reads and writes, including ones served from the page cache)
+# Only available on Linux; elsewhere spans just don't get I/O counts
+def get_io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def add_to_totals(stage, seconds, num_bytes):
+    total = totals.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+    total['count'] += 1
+    total['seconds'] += seconds
+    total['bytes'] += num_bytes or 0
+
+
+# Times one stage. Yields a dict that the stage can add fields to (e.g. 'bytes' for downloads, or a file name), which
+# all end up in the span's JSON line. Spans that raise still get recorded, with the error.
+@contextlib.contextmanager
+def span(stage, **fields):
+    if not is_enabled():
+        yield fields
+        return
+    read_before, written_before = get_io_bytes()
+    cpu_before = time.process_time()
+    start = time.time()
+    error = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        seconds = time.time() - start
+        record = {
+            'run_id': run_id,
+            'script': script,
+            'pid': os.getpid(),
+            'stage': stage,
+            'start': datetime.datetime.fromtimestamp(start).isoformat(),
+            'seconds': round(seconds, 6),
+            'cpu_seconds': round(time.process_time() - cpu_before, 6),
+        }
+        read_after, written_after = get_io_bytes()
+        if read_before is not None:
+            record['bytes_read'] = read_after - read_before
+            record['bytes_written'] = written_after - written_before
+        record.update(fields)
+        if 'bytes' in fields and seconds > 0:
+            record['bytes_per_second'] = round(fields['bytes'] / seconds)
+        if error is not None:
+            record['error'] = error
+        add_to_totals(stage, seconds, fields.get('bytes'))
+        if trace_path is not None:
+            # One write per line in append mode, so lines from several processes don't get mixed up
+            with open(trace_path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+# Adds up the time per stage for this run, from the trace file if there is one (so worker processes get counted too)
+def get_summary():
+    if trace_path is None or not os.path.exists(trace_path):
+        return totals
+    run_totals = {}
+    with open(trace_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('run_id') != run_id:
+                continue
+            total = run_totals.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['bytes'] += record.get('bytes', 0)
+    return run_totals
+
+
+def print_summary():
+    run_totals = get_summary()
+    if len(run_totals) == 0:
+        return
+    print('')
+    print('Time per stage (' + run_id + '):')
+    print('{:<24}{:>8}{:>12}{:>12}{:>14}'.format('stage', 'count', 'total s', 'mean s', 'MB/s'))
+    for stage, total in sorted(run_totals.items(), key=lambda item: item[1]['seconds'], reverse=True):
+        rate = '{:.2f}'.format(total['bytes'] / 1024**2 / total['seconds']) if total['bytes'] > 0 and total['seconds'] > 0 else ''
+        print('{:<24}{:>8}{:>12.2f}{:>12.4f}{:>14}'.format(stage, total['count'], total['seconds'], total['seconds'] / total['count'], rate))
+
+
+# Only the main process gets profiled; worker processes don't run atexit handlers, so cProfile couldn't save from them,
+# but py-spy follows them itself
+def start_profiling():
+    output_prefix = script + '_' + str(os.getpid())
+    if profile == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats(output_prefix + '.prof')
+            print('Profile saved to ' + output_prefix + '.prof. Top functions by cumulative time:')
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        atexit.register(stop)
+    elif profile == 'py-spy':
+        # py-spy stops and saves the flame graph by itself once this process exits
+        try:
+            subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses', '-o', output_prefix + '.svg'])
+            print('Sampling with py-spy; the profile will be saved to ' + output_prefix + '.svg')
+        except OSError:
+            print('py-spy not found; running without profiling...')
+
+
+if profile is not None and is_main_process:
+    start_profiling()
+if summary and is_main_process:
+    atexit.register(print_summary)
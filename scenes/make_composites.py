@@ -0,0 +1,238 @@
+### This script takes a directory of daily mosaics (L2) or daily index rasters (L3) and makes per-period composites
+### Dates are streamed through one at a time into running per-pixel statistics, so memory use is the same whether a
+### period has 5 dates or 60
+
+
+
+# Directory containing the inputs; either L2 mosaics, or one index's directory made by make_derived_products.py
+input_directory = 'E:/sedgwick_reserve/L2_mosaics'
+
+# Directory to save composites to
+output_directory = 'E:/sedgwick_reserve/L3_composites'
+
+# Period to composite over: 'month', or 'season' (DJF, MAM, JJA, SON; December counts towards the next year's DJF)
+period = 'month'
+
+# Statistics to make for each period
+# mean, count, min, max: per-pixel running statistics over all valid observations
+# median: approximate median from a per-pixel histogram (see median_bins and median_range)
+# max_ndvi: best-pixel composite that takes every band from the date with the highest NDVI at that pixel (L2 mosaics only)
+statistics = ['mean', 'count', 'min', 'max', 'median', 'max_ndvi']
+
+# The median is worked out from a histogram of median_bins bins spread evenly over median_range; values outside the
+# range land in the end bins. 256 bins over reflectance or a normalized index gives a median within about 0.004.
+median_bins = 256
+median_range = (-1.0, 1.0)
+
+# Rough ceiling on memory used for the running statistics of one window of the output
+max_memory_mb = 512
+
+
+
+# Import packages
+import datetime
+import os
+import numpy as np
+import rasterio
+import band_math
+import build_manifest
+import raster_output
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+
+# Gets the period a date string (YYYYMMDD...) belongs to, e.g. '2023-06' for months or '2023-JJA' for seasons
+def get_period(date):
+    year = int(date[0:4])
+    month = int(date[4:6])
+    if period == 'month':
+        return str(year) + '-' + str(month).zfill(2)
+    if month == 12:
+        return str(year + 1) + '-DJF'
+    return str(year) + '-' + ['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA', 'SON', 'SON', 'SON'][month - 1]
+
+
+# Works out one grid that covers every input in a period, using the CRS and resolution of the first input
+def get_period_grid(input_paths):
+    with rasterio.open(input_paths[0]) as src:
+        crs = src.crs
+        res_x, res_y = src.res
+        count = src.count
+    left, bottom, right, top = np.inf, np.inf, -np.inf, -np.inf
+    for path in input_paths:
+        with rasterio.open(path) as src:
+            bounds = transform_bounds(src.crs, crs, *src.bounds) if src.crs != crs else src.bounds
+        left, bottom, right, top = min(left, bounds[0]), min(bottom, bounds[1]), max(right, bounds[2]), max(top, bounds[3])
+    # snap the grid to whole pixels
+    left = np.floor(left / res_x) * res_x
+    top = np.ceil(top / res_y) * res_y
+    width = int(np.ceil((right - left) / res_x))
+    height = int(np.ceil((top - bottom) / res_y))
+    return {'crs': crs, 'transform': from_origin(left, top, res_x, res_y), 'width': width, 'height': height, 'count': count}
+
+
+# Opens an input so that windows of the period grid can be read from it; inputs already on the grid are read directly
+def open_on_grid(input_path, grid):
+    src = rasterio.open(input_path)
+    if src.crs == grid['crs'] and src.transform == grid['transform'] and src.shape == (grid['height'], grid['width']):
+        return src, src
+    vrt = WarpedVRT(src, crs=grid['crs'], transform=grid['transform'], height=grid['height'], width=grid['width'], resampling=Resampling.nearest)
+    return src, vrt
+
+
+# Reads a window of every band as float32 physical values with NaN for nodata
+def read_window(src, reader, window):
+    data = reader.read(window=window, masked=True).astype('float32').filled(np.nan)
+    for i in range(data.shape[0]):
+        if src.scales[i] != 1 or src.offsets[i] != 0:
+            data[i] = data[i] * src.scales[i] + src.offsets[i]
+    return data
+
+
+# Full-width strips of rows, sized so the running statistics for one strip stay under max_memory_mb
+def get_strips(grid, num_inputs, period_statistics):
+    bands = grid['count']
+    bytes_per_pixel = bands * 4                                         # the date being read in
+    bytes_per_pixel += bands * (8 + 2 + 4 + 4)                          # sum, count, min, max
+    bytes_per_pixel += bands * (1 + 4)                                  # valid mask and one float32 temporary
+    bytes_per_pixel += bands * (8 + 8)                                  # the statistic being written out (mean is float64)
+    if 'median' in period_statistics:
+        bytes_per_pixel += bands * median_bins * (1 if num_inputs < 256 else 2)
+        bytes_per_pixel += bands * 4 + (8 + 8 + 4)                      # bin numbers, and one band's nonzero indices and bins
+        bytes_per_pixel += bands * (2 + 2 + 1)                          # running count, median bin and comparison in get_median
+    if 'max_ndvi' in period_statistics:
+        bytes_per_pixel += 4 + bands * 4                                # best NDVI so far and the bands that go with it
+    rows = max(1, (max_memory_mb * 1024**2 // bytes_per_pixel) // grid['width'])
+    for row_off in range(0, grid['height'], rows):
+        yield Window(0, row_off, grid['width'], min(rows, grid['height'] - row_off))
+
+
+# Running per-pixel statistics for one window, updated one date at a time
+def make_accumulators(shape, bands, num_inputs, period_statistics):
+    acc = {
+        'sum': np.zeros((bands,) + shape, dtype='float64'),
+        'count': np.zeros((bands,) + shape, dtype='uint16'),
+        'min': np.full((bands,) + shape, np.nan, dtype='float32'),
+        'max': np.full((bands,) + shape, np.nan, dtype='float32'),
+    }
+    if 'median' in period_statistics:
+        acc['histogram'] = np.zeros((bands, median_bins) + shape, dtype='uint8' if num_inputs < 256 else 'uint16')
+    if 'max_ndvi' in period_statistics:
+        acc['best_ndvi'] = np.full(shape, -np.inf, dtype='float32')
+        acc['best_bands'] = np.full((bands,) + shape, np.nan, dtype='float32')
+    return acc
+
+
+def update_accumulators(acc, data):
+    valid = np.isfinite(data)
+    acc['sum'] += np.where(valid, data, 0)
+    acc['count'] += valid
+    acc['min'] = np.fmin(acc['min'], data)
+    acc['max'] = np.fmax(acc['max'], data)
+    if 'histogram' in acc:
+        low, high = median_range
+        with np.errstate(invalid='ignore'):
+            bins = np.clip(np.nan_to_num((data - low) / (high - low) * median_bins).astype('int32'), 0, median_bins - 1)
+        # one band at a time, so the index arrays only ever cover one band's worth of pixels
+        for band in range(data.shape[0]):
+            row_index, col_index = np.nonzero(valid[band])
+            np.add.at(acc['histogram'][band], (bins[band][valid[band]], row_index, col_index), 1)
+    if 'best_ndvi' in acc:
+        bands = {band: data[number - 1] for band, number in band_math.band_numbers.items()}
+        ndvi = ndvi_evaluator(bands)
+        better = np.isfinite(ndvi) & (ndvi > acc['best_ndvi'])
+        acc['best_ndvi'][better] = ndvi[better]
+        acc['best_bands'][:, better] = data[:, better]
+
+
+# Approximate per-pixel median: the centre of the histogram bin where the cumulative count passes half the total
+# Walks the bins with a running count rather than building the whole cumulative histogram, which would take several
+# times the histogram's own memory; the median bin is the number of bins the running count is still short of half at
+def get_median(acc):
+    low, high = median_range
+    half = (acc['count'] + 1) // 2
+    running = np.zeros(half.shape, dtype='uint16')
+    median_bin = np.zeros(half.shape, dtype='uint16')
+    for i in range(median_bins):
+        running += acc['histogram'][:, i]
+        median_bin += running < half
+    median = low + (median_bin.astype('float32') + 0.5) * np.float32((high - low) / median_bins)
+    median[acc['count'] == 0] = np.nan
+    return median
+
+
+def get_statistic(acc, statistic):
+    if statistic == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(acc['count'] > 0, acc['sum'] / acc['count'], np.nan)
+    if statistic == 'count':
+        return acc['count'].astype('float32')
+    if statistic == 'min':
+        return acc['min']
+    if statistic == 'max':
+        return acc['max']
+    if statistic == 'median':
+        return get_median(acc)
+    if statistic == 'max_ndvi':
+        return acc['best_bands']
+
+
+ndvi_evaluator = band_math.compile_expression(band_math.indices['ndvi'])
+
+
+# Makes every composite for one period, streaming each window of each date through the running statistics
+def make_composites_for_period(this_period, input_paths, period_statistics):
+    grid = get_period_grid(input_paths)
+    level = 'L2' if grid['count'] == 4 else 'L3'
+    profile = raster_output.get_profile(level)
+    output_paths = {statistic: os.path.join(output_directory, this_period + '_' + statistic + '.tif') for statistic in period_statistics}
+    dsts = {statistic: raster_output.open_streaming_output(output_paths[statistic], grid['count'], grid['height'], grid['width'], grid['crs'], grid['transform'], profile) for statistic in period_statistics}
+    readers = [open_on_grid(path, grid) for path in input_paths]
+    try:
+        for window in get_strips(grid, len(input_paths), period_statistics):
+            acc = make_accumulators((int(window.height), int(window.width)), grid['count'], len(input_paths), period_statistics)
+            for src, reader in readers:
+                update_accumulators(acc, read_window(src, reader, window))
+            for statistic in period_statistics:
+                raster_output.write_window(dsts[statistic], get_statistic(acc, statistic), window, profile)
+    finally:
+        for src, reader in readers:
+            if reader is not src:
+                reader.close()
+            src.close()
+    for statistic in period_statistics:
+        raster_output.finish_streaming_output(dsts[statistic], output_paths[statistic], profile)
+
+
+
+if __name__ == '__main__':
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Group the inputs by period
+    inputs = sorted([file for file in os.listdir(input_directory) if file.endswith('.tif')])
+    periods = {}
+    for file in inputs:
+        periods.setdefault(get_period(file[:8]), []).append(os.path.join(input_directory, file))
+
+    # Only remake composites whose inputs have changed (e.g. a late-arriving date) or whose settings have changed
+    manifest_path = os.path.join(output_directory, 'manifest.json')
+    manifest = build_manifest.load_manifest(manifest_path)
+    definition = build_manifest.get_definition_version({'statistics': statistics, 'median_bins': median_bins, 'median_range': median_range})
+    for count, this_period in enumerate(sorted(periods)):
+        input_paths = periods[this_period]
+        input_signatures = [build_manifest.get_file_signature(path) for path in input_paths]
+        period_statistics = [statistic for statistic in statistics if not build_manifest.is_up_to_date(manifest, this_period + '_' + statistic, os.path.join(output_directory, this_period + '_' + statistic + '.tif'), input_signatures, definition)]
+        with rasterio.open(input_paths[0]) as src:
+            if src.count != 4 and 'max_ndvi' in period_statistics:
+                period_statistics.remove('max_ndvi')
+        if len(period_statistics) == 0:
+            continue
+        print(str(datetime.datetime.now().time()) + '    Making ' + this_period + ' composites from ' + str(len(input_paths)) + ' dates (' + str(count+1) + ' of ' + str(len(periods)) + ')...')
+        make_composites_for_period(this_period, input_paths, period_statistics)
+        for statistic in period_statistics:
+            build_manifest.record_output(manifest, this_period + '_' + statistic, input_signatures, definition)
+        build_manifest.save_manifest(manifest, manifest_path)
@@ -9,247 +9,271 @@ mosaic_directory = 'E:/sedgwick_reserve/L2_mosaics'
 # Directory to save mosaics to
 indices_directory = 'E:/sedgwick_reserve/L3_indices'
 
-# Toggles for derived products to make
-make_ndvi = True            # Normalized Difference Vegetation Index
-make_ndwi = True            # Normalized Difference Water Index
-make_msavi2 = True          # Modified Soil Adjusted Vegetation Index 2
-make_mtvi2 = True           # Modified Triangular Vegetation Index 2
-make_vari = True            # Visible Atmospherically Resistant Index
-make_tgi = True             # Triangular Greenness Index
+# Derived products to make; these can be any of the indices defined in band_math.py
+# ndvi: Normalized Difference Vegetation Index
+# ndwi: Normalized Difference Water Index
+# msavi2: Modified Soil Adjusted Vegetation Index 2
+# mtvi2: Modified Triangular Vegetation Index 2
+# vari: Visible Atmospherically Resistant Index
+# tgi: Triangular Greenness Index
+# evi: Enhanced Vegetation Index
+# savi: Soil Adjusted Vegetation Index
+enabled_indices = ['ndvi', 'ndwi', 'msavi2', 'mtvi2', 'vari', 'tgi']
+
+# Streaming mode works through each mosaic a few internal blocks at a time and writes outputs block-by-block,
+# so memory use depends on the block size rather than the size of the mosaic. Use this for county-scale AOIs.
+streaming = False
+max_memory_mb = 512         # Rough ceiling on memory used while making indices for one mosaic in streaming mode
+
+# Number of processes to spread mosaics across; can also be set on the command line with --workers
+# NOTE: in streaming mode each worker uses up to max_memory_mb, so total memory is roughly workers * max_memory_mb
+workers = 1
+
+# Per-index changes to the L3 output profile in raster_output.py (by default, float32 COGs with DEFLATE compression)
+# e.g. {'ndvi': {'dtype': 'int16', 'scale': 0.0001, 'nodata': -32768}, 'tgi': {'compress': 'ZSTD'}}
+output_profiles = {}
+
+# Outputs only get rebuilt when their mosaic or their definition (index expression + output profile) has changed.
+# This is tracked in manifest.json in the indices directory. By default a mosaic counts as changed when its size or
+# modification time changes; with use_content_hash it has to actually have different contents (each mosaic gets hashed
+# the first time it's seen and again whenever it's touched).
+use_content_hash = False
+
+# Also append each date's indices to a chunked, compressed datacube (time x y x x, one variable per index) so a
+# pixel's whole time series can be read without opening hundreds of GeoTIFFs. Needs xarray and zarr 3 or newer.
+# The grid of the first date written sets the grid for the whole cube. Set to None to only write GeoTIFFs.
+datacube_path = None        # e.g. 'E:/sedgwick_reserve/L3_datacube.zarr'
+datacube_chunks = (16, 256, 256)    # (time, y, x)
 
 
 
 # Import packages
+import argparse
+import datetime
 import os
-import rioxarray as rxr
-
-
-# List all .tif files in the mosaic directory
-mosaics = os.listdir(mosaic_directory)
-mosaics = [file for file in mosaics if file[-4:] == '.tif']
-
+import rasterio
+import band_math
+import build_manifest
+import instrumentation
+import raster_output
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rasterio.windows import Window
 
 
 
 #### Index functions ####
-#### All equations were taken from Planet's developer tool website: https://developers.planet.com/docs/basemaps/tile-services/indices/#remote-sensing-indices-legends"
-
-
-
-# NDVI: Normalized Difference Vegetation Index
-def get_ndvi(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    red = mosaic.sel(band=3)
-    nir = mosaic.sel(band=4)
-    ndvi = (nir - red) / (nir + red)
-    return ndvi
-
-# NDWI: Normalized Difference Water Index
-# NOTE: This is the version of NDWI that uses green and NIR bands, NOT the version that uses SWIR bands
-def get_ndwi(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    green = mosaic.sel(band=2)
-    nir = mosaic.sel(band=4)
-    ndwi = (green - nir) / (green + nir)
-    return ndwi
-
-# MSAVI2: Modified Soil Adjusted Vegetation Index 2
-def get_msavi2(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    red = mosaic.sel(band=3)
-    nir = mosaic.sel(band=4)
-    msavi2 = (2*nir + 1 - ((2*nir + 1)**2 - 8*(nir - red))**0.5) / 2
-    return msavi2
-
-# MTVI2: Modified Triangular Vegetation Index 2
-def get_mtvi2(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    green = mosaic.sel(band=2)
-    red = mosaic.sel(band=3)
-    nir = mosaic.sel(band=4)
-    mtvi2 = 1.5 * (1.2 * (nir - green) - 2.5 * (red - green)) / (((2*nir+1)**2 - (6*nir-5*(red)**0.5))**0.5-0.5)
-    return mtvi2
-
-# VARI: Visible Atmospherically Resistant Index
-def get_vari(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    blue = mosaic.sel(band=1)
-    green = mosaic.sel(band=2)
-    red = mosaic.sel(band=3)
-    vari = (green - red) / (green + red - blue)
-    return vari
-
-# TGI: Triangular Greenness Index
-def get_tgi(img_path):
-    mosaic = rxr.open_rasterio(img_path)
-    blue = mosaic.sel(band=1)
-    green = mosaic.sel(band=2)
-    red = mosaic.sel(band=3)
-    tgi = (120*(red-blue)-(190*(red-green))) / (2)
-    return tgi
-
-
-
-
-
-#### Make derived products ####
-
-# NDVI: Normalized Difference Vegetation Index
-if make_ndvi:
-    # Check if there is an NDVI directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'ndvi')):
-        os.makedirs(os.path.join(indices_directory, 'ndvi'))
-
-    # Check which dates we already have NDVI for
-    existing_files = os.listdir(os.path.join(indices_directory, 'ndvi'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    ndvi_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
-
-    if len(ndvi_mosaics) == 0:
-        print('All input images already have NDVI mosaics. Moving on...')
-    if len(ndvi_mosaics) == len(mosaics):
-        print('Making NDVI mosaics for ' + str(len(ndvi_mosaics)) + ' images...')
+#### Each index is an expression in band_math.py, compiled once into a fused evaluator that takes the bands as arrays.
+#### The bands are read from the mosaic once and shared by every index made from it.
+evaluators = {index: band_math.compile_expression(band_math.indices[index]) for index in enabled_indices}
+
+
+# Gets the path that a given index of a given mosaic gets saved to
+def get_output_path(mosaic, index):
+    return os.path.join(indices_directory, index, mosaic[:-4] + '_' + index + '.tif')
+
+
+# Key for an output in the build manifest (its path relative to the indices directory)
+def get_output_key(mosaic, index):
+    return index + '/' + mosaic[:-4] + '_' + index + '.tif'
+
+
+# Version of everything that goes into making an index other than the mosaic itself
+def get_definition_version(index):
+    return build_manifest.get_definition_version({
+        'expression': band_math.indices[index],
+        'profile': raster_output.get_profile('L3', output_profiles.get(index)),
+    })
+
+
+# Writing straight to the output path means an interrupted run leaves a half-written file behind, which the skip logic
+# would then treat as done. Instead, outputs get written to a temporary file next to the output path and renamed into
+# place once they're complete (os.replace is atomic when both paths are on the same drive).
+def get_temp_path(output_path):
+    return output_path + '.' + str(os.getpid()) + '.tmp'
+
+
+# Opens a mosaic once, reads the blue/green/red/NIR bands once, and makes every requested index from those shared bands
+# mosaic: file name of the mosaic in the mosaic directory
+# indices: list of index names (keys of band_math.indices) to make for this mosaic
+def make_indices_for_mosaic(mosaic, indices):
+    with instrumentation.span('read', file=mosaic), rasterio.open(os.path.join(mosaic_directory, mosaic)) as src:
+        data = raster_output.read_scaled(src, list(band_math.band_numbers.values()))
+        crs = src.crs
+        transform = src.transform
+    bands = {band: data[i] for i, band in enumerate(band_math.band_numbers)}
+    for index in indices:
+        output_path = get_output_path(mosaic, index)
+        profile = raster_output.get_profile('L3', output_profiles.get(index))
+        with instrumentation.span('index_math', index=index):
+            result = evaluators[index](bands)
+        with instrumentation.span('write', file=os.path.basename(output_path), cog=True):
+            raster_output.write_cog(result, get_temp_path(output_path), crs, transform, profile, [index])
+            os.replace(get_temp_path(output_path), output_path)
+
+
+# Works out which windows to read a mosaic in so that each one stays under max_memory_mb
+# Windows are built out of whole internal blocks so that no block is decoded more than once
+# src: open rasterio dataset
+# num_indices: number of indices being made at once (each one is another array in memory)
+def get_windows(src, num_indices):
+    # 4 input bands + 1 output per index + a couple of temporaries for the fused evaluator, all float32
+    bytes_per_pixel = (4 + num_indices + 2) * 4
+    max_pixels = max_memory_mb * 1024**2 // bytes_per_pixel
+    block_height, block_width = src.block_shapes[0]
+
+    # Full-width strips of as many block rows as fit; if a single block row is already too big, split it into columns too
+    if src.width * block_height <= max_pixels:
+        window_height = max(block_height, (max_pixels // src.width) // block_height * block_height)
+        window_width = src.width
     else:
-        print('NDVI images already found for ' + str(len(mosaics)-len(ndvi_mosaics)) + ' input mosaics. Calculating NDVI for ' + str(len(ndvi_mosaics)) + ' dates...')
-
-    # Loop through all mosaics and make an NDVI mosaic for each one
-    for mosaic in ndvi_mosaics:
-        print('Making NDVI mosaic for ' + mosaic + '...')
-        ndvi = get_ndvi(os.path.join(mosaic_directory, mosaic))
-        ndvi.rio.to_raster(os.path.join(indices_directory, 'ndvi', mosaic[:-4] + '_ndvi.tif'))
-
-
-
-# NDWI: Normalized Difference Water Index
-if make_ndwi:
-    # Check if there is an NDWI directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'ndwi')):
-        os.makedirs(os.path.join(indices_directory, 'ndwi'))
-
-    # Check which dates we already have NDWI for
-    existing_files = os.listdir(os.path.join(indices_directory, 'ndwi'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    ndwi_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
-
-    if len(ndwi_mosaics) == 0:
-        print('All input images already have NDWI mosaics. Moving on...')
-    if len(ndwi_mosaics) == len(mosaics):
-        print('Making NDWI mosaics for ' + str(len(ndwi_mosaics)) + ' images...')
-    else:
-        print('NDWI images already found for ' + str(len(mosaics)-len(ndwi_mosaics)) + ' input mosaics. Calculating NDWI for ' + str(len(ndwi_mosaics)) + ' dates...')
-
-    # Loop through all mosaics and make an NDWI mosaic for each one
-    for mosaic in ndwi_mosaics:
-        print('Making NDWI mosaic for ' + mosaic + '...')
-        ndwi = get_ndwi(os.path.join(mosaic_directory, mosaic))
-        ndwi.rio.to_raster(os.path.join(indices_directory, 'ndwi', mosaic[:-4] + '_ndwi.tif'))
+        window_height = block_height
+        window_width = max(block_width, (max_pixels // block_height) // block_width * block_width)
+
+    for row_off in range(0, src.height, window_height):
+        for col_off in range(0, src.width, window_width):
+            yield Window(col_off, row_off, min(window_width, src.width - col_off), min(window_height, src.height - row_off))
+
+
+# Same as make_indices_for_mosaic, but only ever holds one window of the mosaic in memory at a time
+def make_indices_for_mosaic_streaming(mosaic, indices):
+    with rasterio.open(os.path.join(mosaic_directory, mosaic)) as src:
+        profiles = {index: raster_output.get_profile('L3', output_profiles.get(index)) for index in indices}
+        temp_paths = {index: get_temp_path(get_output_path(mosaic, index)) for index in indices}
+        dsts = {index: raster_output.open_streaming_output(temp_paths[index], 1, src.height, src.width, src.crs, src.transform, profiles[index], [index]) for index in indices}
+        try:
+            for window in get_windows(src, len(indices)):
+                with instrumentation.span('read'):
+                    data = raster_output.read_scaled(src, list(band_math.band_numbers.values()), window=window)
+                bands = {band: data[i] for i, band in enumerate(band_math.band_numbers)}
+                for index in indices:
+                    with instrumentation.span('index_math', index=index):
+                        result = evaluators[index](bands)
+                    with instrumentation.span('write'):
+                        raster_output.write_window(dsts[index], result, window, profiles[index])
+        except:
+            for index in indices:
+                dsts[index].close()
+                os.remove(raster_output.get_streaming_path(temp_paths[index]))
+            raise
+    for index in indices:
+        with instrumentation.span('write', file=os.path.basename(get_output_path(mosaic, index)), cog=True):
+            raster_output.finish_streaming_output(dsts[index], temp_paths[index], profiles[index])
+            os.replace(temp_paths[index], get_output_path(mosaic, index))
+
+
+# Makes all the missing indices for one mosaic; this is the unit of work handed to each worker process
+# Indices for the same mosaic stay together so that each mosaic is still only read once
+def make_indices(mosaic, indices):
+    with instrumentation.span('make_indices', file=mosaic, indices=len(indices)):
+        if streaming:
+            make_indices_for_mosaic_streaming(mosaic, indices)
+        else:
+            make_indices_for_mosaic(mosaic, indices)
 
 
 
-# MSAVI2: Modified Soil Adjusted Vegetation Index 2
-if make_msavi2:
-    # Check if there is an MSAVI2 directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'msavi2')):
-        os.makedirs(os.path.join(indices_directory, 'msavi2'))
 
-    # Check which dates we already have MSAVI2 for
-    existing_files = os.listdir(os.path.join(indices_directory, 'msavi2'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    msavi2_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
 
-    if len(msavi2_mosaics) == 0:
-        print('All input images already have MSAVI2 mosaics. Moving on...')
-    if len(msavi2_mosaics) == len(mosaics):
-        print('Making MSAVI2 mosaics for ' + str(len(msavi2_mosaics)) + ' images...')
-    else:
-        print('MSAVI2 images already found for ' + str(len(mosaics)-len(msavi2_mosaics)) + ' input mosaics. Calculating MSAVI2 for ' + str(len(msavi2_mosaics)) + ' dates...')
-
-    # Loop through all mosaics and make an MSAVI2 mosaic for each one
-    for mosaic in msavi2_mosaics:
-        print('Making MSAVI2 mosaic for ' + mosaic + '...')
-        msavi2 = get_msavi2(os.path.join(mosaic_directory, mosaic))
-        msavi2.rio.to_raster(os.path.join(indices_directory, 'msavi2', mosaic[:-4] + '_msavi2.tif'))
-
-
-
-# MTVI2: Modified Triangular Vegetation Index 2
-if make_mtvi2:
-    # Check if there is an MTVI2 directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'mtvi2')):
-        os.makedirs(os.path.join(indices_directory, 'mtvi2'))
-
-    # Check which dates we already have MTVI2 for
-    existing_files = os.listdir(os.path.join(indices_directory, 'mtvi2'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    mtvi2_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
-
-    if len(mtvi2_mosaics) == 0:
-        print('All input images already have MTVI2 mosaics. Moving on...')
-    if len(mtvi2_mosaics) == len(mosaics):
-        print('Making MTVI2 mosaics for ' + str(len(mtvi2_mosaics)) + ' images...')
-    else:
-        print('MTVI2 images already found for ' + str(len(mosaics)-len(mtvi2_mosaics)) + ' input mosaics. Calculating MTVI2 for ' + str(len(mtvi2_mosaics)) + ' dates...')
-
-    # Loop through all mosaics and make an MTVI2 mosaic for each one
-    for mosaic in mtvi2_mosaics:
-        print('Making MTVI2 mosaic for ' + mosaic + '...')
-        mtvi2 = get_mtvi2(os.path.join(mosaic_directory, mosaic))
-        mtvi2.rio.to_raster(os.path.join(indices_directory, 'mtvi2', mosaic[:-4] + '_mtvi2.tif'))
-        
-
-
-# VARI: Visible Atmospherically Resistant Index
-if make_vari:
-    # Check if there is an VARI directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'vari')):
-        os.makedirs(os.path.join(indices_directory, 'vari'))
-
-    # Check which dates we already have VARI for
-    existing_files = os.listdir(os.path.join(indices_directory, 'vari'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    vari_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
-
-    if len(vari_mosaics) == 0:
-        print('All input images already have VARI mosaics. Moving on...')
-    if len(vari_mosaics) == len(mosaics):
-        print('Making VARI mosaics for ' + str(len(vari_mosaics)) + ' images...')
-    else:
-        print('VARI images already found for ' + str(len(mosaics)-len(vari_mosaics)) + ' input mosaics. Calculating VARI for ' + str(len(vari_mosaics)) + ' dates...')
-
-    # Loop through all mosaics and make an VARI mosaic for each one
-    for mosaic in vari_mosaics:
-        print('Making VARI mosaic for ' + mosaic + '...')
-        vari = get_vari(os.path.join(mosaic_directory, mosaic))
-        vari.rio.to_raster(os.path.join(indices_directory, 'vari', mosaic[:-4] + '_vari.tif'))
-
-
-
-# TGI: Triangular Greenness Index
-if make_tgi:
-    # Check if there is an TGI directory; if not, make one
-    if not os.path.exists(os.path.join(indices_directory, 'tgi')):
-        os.makedirs(os.path.join(indices_directory, 'tgi'))
-
-    # Check which dates we already have TGI for
-    existing_files = os.listdir(os.path.join(indices_directory, 'tgi'))
-    existing_datetimes = [file[:-9] for file in existing_files]
-    existing_datetimes = list(set(existing_datetimes))
-    tgi_mosaics = [mosaic for mosaic in mosaics if mosaic[:-4] not in existing_datetimes]
-
-    if len(tgi_mosaics) == 0:
-        print('All input images already have TGI mosaics. Moving on...')
-    if len(tgi_mosaics) == len(mosaics):
-        print('Making TGI mosaics for ' + str(len(tgi_mosaics)) + ' images...')
-    else:
-        print('TGI images already found for ' + str(len(mosaics)-len(tgi_mosaics)) + ' input mosaics. Calculating TGI for ' + str(len(tgi_mosaics)) + ' dates...')
+#### Make derived products ####
 
-    # Loop through all mosaics and make an TGI mosaic for each one
-    for mosaic in tgi_mosaics:
-        print('Making TGI mosaic for ' + mosaic + '...')
-        tgi = get_tgi(os.path.join(mosaic_directory, mosaic))
-        tgi.rio.to_raster(os.path.join(indices_directory, 'tgi', mosaic[:-4] + '_tgi.tif'))
\ No newline at end of file
+# Everything below only runs in the main process; worker processes just import the functions above
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Makes derived products (L3) from a directory of mosaics (L2)')
+    parser.add_argument('--workers', type=int, default=workers, help='number of processes to make derived products with')
+    args = parser.parse_args()
+
+    # List all .tif files in the mosaic directory
+    mosaics = os.listdir(mosaic_directory)
+    mosaics = [file for file in mosaics if file[-4:] == '.tif']
+
+    # Check if there is a directory for each index; if not, make one
+    # Also clean up any temporary files left behind by a run that got interrupted
+    for index in enabled_indices:
+        if not os.path.exists(os.path.join(indices_directory, index)):
+            os.makedirs(os.path.join(indices_directory, index))
+        for file in os.listdir(os.path.join(indices_directory, index)):
+            if file.endswith('.tmp'):
+                os.remove(os.path.join(indices_directory, index, file))
+
+    # Check which indices are already up to date for each mosaic
+    manifest_path = os.path.join(indices_directory, 'manifest.json')
+    manifest = build_manifest.load_manifest(manifest_path)
+    definitions = {index: get_definition_version(index) for index in enabled_indices}
+    input_signatures = {}
+    missing_indices = {}
+    for mosaic in mosaics:
+        mosaic_path = os.path.join(mosaic_directory, mosaic)
+        previous = [build_manifest.get_previous_signatures(manifest, get_output_key(mosaic, index), [mosaic_path])[0] for index in enabled_indices]
+        previous = next((signature for signature in previous if signature is not None), None)
+        input_signatures[mosaic] = [build_manifest.get_file_signature(mosaic_path, use_content_hash, previous)]
+        this_missing = []
+        for index in enabled_indices:
+            output_key = get_output_key(mosaic, index)
+            output_path = get_output_path(mosaic, index)
+            if build_manifest.is_up_to_date(manifest, output_key, output_path, input_signatures[mosaic], definitions[index]):
+                continue
+            # Outputs made before there was a manifest get adopted, as long as they're newer than their mosaic
+            if output_key not in manifest['outputs'] and os.path.exists(output_path) and os.stat(output_path).st_mtime_ns >= input_signatures[mosaic][0]['mtime']:
+                build_manifest.record_output(manifest, output_key, input_signatures[mosaic], definitions[index])
+                continue
+            this_missing.append(index)
+        if len(this_missing) > 0:
+            missing_indices[mosaic] = this_missing
+    build_manifest.save_manifest(manifest, manifest_path)
+
+    for index in enabled_indices:
+        num_missing = len([mosaic for mosaic in missing_indices if index in missing_indices[mosaic]])
+        if num_missing == 0:
+            print('All ' + index.upper() + ' mosaics are up to date. Moving on...')
+        elif num_missing == len(mosaics):
+            print('Making ' + index.upper() + ' mosaics for ' + str(num_missing) + ' images...')
+        else:
+            print(index.upper() + ' images are up to date for ' + str(len(mosaics)-num_missing) + ' input mosaics. Calculating ' + index.upper() + ' for ' + str(num_missing) + ' dates...')
+
+    # Records a mosaic's indices in the manifest once they've been made; the manifest gets saved every so often
+    # (and at the end) so an interrupted run keeps track of most of what it finished
+    # Also keeps track of the mosaics rebuilt this run, so their dates can be rewritten in the datacube
+    rebuilt_mosaics = set()
+    def record_mosaic(mosaic, count):
+        rebuilt_mosaics.add(mosaic)
+        for index in missing_indices[mosaic]:
+            build_manifest.record_output(manifest, get_output_key(mosaic, index), input_signatures[mosaic], definitions[index])
+        if count % 50 == 0:
+            build_manifest.save_manifest(manifest, manifest_path)
+
+    # Loop through all mosaics, reading each one once and making all of its missing indices
+    # A failure on one mosaic gets reported but doesn't stop the rest of the run
+    try:
+        if args.workers <= 1:
+            for count, mosaic in enumerate(missing_indices):
+                print(str(datetime.datetime.now().time()) + '    Making ' + ', '.join([index.upper() for index in missing_indices[mosaic]]) + ' for ' + mosaic + ' (' + str(count+1) + ' of ' + str(len(missing_indices)) + ')...')
+                try:
+                    make_indices(mosaic, missing_indices[mosaic])
+                    record_mosaic(mosaic, count+1)
+                except Exception as e:
+                    print(str(datetime.datetime.now().time()) + '    Failed to make indices for ' + mosaic + ': ' + repr(e))
+        else:
+            print('Spreading ' + str(len(missing_indices)) + ' mosaics across ' + str(args.workers) + ' worker processes...')
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = {executor.submit(make_indices, mosaic, missing_indices[mosaic]): mosaic for mosaic in missing_indices}
+                for count, future in enumerate(as_completed(futures)):
+                    mosaic = futures[future]
+                    try:
+                        future.result()
+                        record_mosaic(mosaic, count+1)
+                        print(str(datetime.datetime.now().time()) + '    Finished ' + mosaic + ' (' + str(count+1) + ' of ' + str(len(missing_indices)) + ')')
+                    except Exception as e:
+                        print(str(datetime.datetime.now().time()) + '    Failed to make indices for ' + mosaic + ': ' + repr(e))
+    finally:
+        build_manifest.save_manifest(manifest, manifest_path)
+
+    # Add any dates that have every enabled index to the datacube, and rewrite the ones whose indices were just rebuilt
+    if datacube_path is not None:
+        import datacube
+        cube_dates = {}
+        for mosaic in mosaics:
+            raster_paths = {index: get_output_path(mosaic, index) for index in enabled_indices}
+            if all(os.path.exists(path) for path in raster_paths.values()):
+                cube_dates[mosaic[:-4]] = raster_paths
+        if len(cube_dates) > 0:
+            datacube.append_dates(datacube_path, cube_dates, datacube_chunks, rebuilt_dates=[mosaic[:-4] for mosaic in rebuilt_mosaics])
@@ -15,29 +15,315 @@ input_geojson = 'E:/sedgwick_reserve/Sedgwick_Reserve.geojson'
 # Desired EPSG code of the output mosaic
 dst_epsg = 32610
 
+# Catalog of every scene in the imagery directory; it gets brought up to date at the start of each run
+catalog_path = 'E:/sedgwick_reserve/L1_harmonized_scenes/scene_catalog.sqlite'
+compute_checksums = False   # Also store a sha256 of each new scene in the catalog
+
+# Resolution of the output mosaic in meters; mosaics are made on a grid snapped to the AOI's bounds at this resolution
+dst_resolution = 3
+
+# Streaming mode builds the mosaic one block at a time. For each block, only the part of each scene that overlaps it
+# gets read (in priority order), stopping as soon as every pixel in the block is filled, so memory use depends on
+# block_size rather than on the size of the AOI or how many scenes there are
+streaming = False
+block_size = 1024
+
+# How scenes get combined into a mosaic
+# 'painter': scenes are stacked by AOI coverage, and each pixel comes from the highest-ranked scene that's clear there
+# 'best_pixel': every candidate pixel gets scored from all of its scene's UDM2 bands (plus view angle, if the scene's
+#     metadata JSON is there), and each pixel comes from whichever scene scores best
+compositing = 'painter'
+
+# Scoring for best_pixel compositing; each UDM2 flag that's set adds its weight, confidence (0-100) adds
+# confidence * udm2_weights['confidence'] / 100, and every degree off nadir subtracts view_angle_weight.
+# Pixels flagged unusable (band 8) or with no data never get picked, and neither do pixels scoring min_pixel_score or less.
+udm2_weights = {
+    'clear': 1.0,
+    'snow': -1.0,
+    'shadow': -1.0,
+    'light_haze': -0.3,
+    'heavy_haze': -1.0,
+    'cloud': -2.0,
+    'confidence': 0.5,
+}
+view_angle_weight = 0.02
+min_pixel_score = 0
+
+# Dates get built in parallel by this many worker processes (can also be set with --workers). A date only starts once
+# its estimated memory need fits in ram_budget_mb alongside the dates already being built (can also be set with
+# --ram-budget-mb), so a few huge days can't run the machine out of memory while small days fill the spare cores.
+# Each worker's GDAL block cache is capped at gdal_cache_mb so the estimates hold.
+workers = 1
+ram_budget_mb = 16000
+gdal_cache_mb = 256
+
+# Scenes get stacked in order of how much of the AOI their footprint covers. With rank_by_clear_fraction, that coverage
+# also gets weighted by the fraction of clear pixels in the scene, read from a low-resolution (1/udm2_overview_factor) UDM2
+rank_by_clear_fraction = True
+udm2_overview_factor = 16
+
+# Keep mosaics as uint16 (with 0 as nodata) all the way through masking and merging instead of turning them into NaN-masked
+# floats. The 1/10000 scale factor gets written into the GeoTIFF as scale metadata rather than applied to the data, and
+# make_derived_products.py applies it as it reads each block. Takes about half the memory and disk space of float32.
+keep_integers = False
+
+# Incremental mode re-checks dates that already have a mosaic against the scene catalog, using the scene list in each
+# date's _metadata.json. Dates whose scenes haven't changed get skipped. If scenes have only been added (e.g. a late order
+# arrived), only the blocks of the existing mosaic that the new scenes touch get repainted; anything else (scenes removed,
+# different settings, or an existing mosaic on a different grid) gets the whole date rebuilt.
+incremental = True
+
+# Changes to the L2 output profile in raster_output.py (by default, float32 COGs with DEFLATE compression)
+# e.g. {'dtype': 'int16', 'scale': 0.0001, 'nodata': -32768} to store reflectance as scaled integers
+output_profile = {}
+
 
 
 # Import packages
+import argparse
 import datetime
 import os
+import traceback
 import geopandas as gpd
 import rasterio
 import json
-from rasterio.mask import mask
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from rasterio.crs import CRS
-import rioxarray as rxr
-from rioxarray.merge import merge_arrays
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+import rasterio.windows
+from shapely.geometry import box, mapping, shape
 import numpy as np
-import xarray as xa
+import rasterio.shutil
+import instrumentation
+import raster_output
+import scene_catalog
+
+
+# gets the path of the UDM2 that goes with an SR image
+def get_udm_path(file):
+    return file.split('3B')[0] + '3B_udm2_clip.tif'     # 3B is the code for the analytic SR data product
+
+# fraction of a scene's pixels that are clear, from a decimated read of UDM2 band 1 (uses the UDM2's overviews if it has any)
+def get_clear_fraction(udm_path):
+    with rasterio.open(udm_path) as udm:
+        out_shape = (max(1, udm.height // udm2_overview_factor), max(1, udm.width // udm2_overview_factor))
+        clear = udm.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+    return np.count_nonzero(clear == 1) / clear.size
+
+# scores each scene by how much of the AOI it covers, using only its footprint (and optionally a low-res UDM2)
+# so no scene has to be read at full resolution just to be ranked
+# returns the scenes that overlap the AOI at all, best first
+def rank_scenes(list_of_imgs, dst_crs, polygon):
+    scores = []
+    for file in list_of_imgs:
+        with instrumentation.span('raster_open', file=os.path.basename(file)), rasterio.open(os.path.join(imagery_directory, file)) as src:
+            footprint = shape(transform_geom(src.crs, dst_crs, mapping(box(*src.bounds))))
+        score = footprint.intersection(polygon).area
+        if rank_by_clear_fraction and score > 0:
+            try:
+                score *= get_clear_fraction(os.path.join(imagery_directory, get_udm_path(file)))
+            except RasterioIOError:
+                pass    # missing UDMs get reported (and the scene skipped) when the scene is opened
+        scores.append(score)
+    ranked = sorted(zip(scores, list_of_imgs), key=lambda pair: pair[0], reverse=True)
+    return [file for score, file in ranked if score > 0]
+
+# works out the output grid for an AOI: its bounds in the target CRS, snapped outwards to whole pixels
+# returns the grid's transform, width and height
+def get_aoi_grid(polygon, resolution):
+    left, bottom, right, top = polygon.bounds
+    left = np.floor(left / resolution) * resolution
+    bottom = np.floor(bottom / resolution) * resolution
+    right = np.ceil(right / resolution) * resolution
+    top = np.ceil(top / resolution) * resolution
+    return from_origin(left, top, resolution, resolution), int(round((right - left) / resolution)), int(round((top - bottom) / resolution))
+
+# gets a scene's view angle (degrees off nadir) from the metadata JSON Planet delivers with it, or 0 if it isn't there
+def get_view_angle(file):
+    metadata_path = os.path.join(imagery_directory, file.split('3B')[0] + 'metadata.json')
+    try:
+        with open(metadata_path) as f:
+            return abs(json.load(f)['properties']['view_angle'])
+    except (OSError, KeyError, ValueError):
+        return 0
+
+# if a dataset already sits on the output grid (same CRS and pixel size, with its pixels lined up with the grid's, e.g.
+# scenes reprojected by Planet at order time), returns the (row, col) of its top left pixel on the grid; otherwise None
+def get_grid_offset(dataset, dst_crs, transform):
+    src_transform = dataset.transform
+    if dataset.crs != dst_crs or src_transform.b != 0 or src_transform.d != 0:
+        return None
+    if abs(src_transform.a - transform.a) > 1e-6 or abs(src_transform.e - transform.e) > 1e-6:
+        return None
+    col = (src_transform.c - transform.c) / transform.a
+    row = (src_transform.f - transform.f) / transform.e
+    if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+        return None
+    return int(round(row)), int(round(col))
+
+# opens a scene and its UDM2 so that windows of the output grid can be read from them. Anything not already on the grid
+# gets a WarpedVRT, so it's warped straight onto the AOI grid as it's read (one warp per scene, and nothing outside the
+# AOI ever gets warped); anything already on the grid gets read directly with no warping at all
+# returns None if the scene has no UDM2
+def open_scene(file, dst_crs, transform, width, height):
+    with instrumentation.span('raster_open', file=os.path.basename(file)):
+        try:
+            udm = rasterio.open(os.path.join(imagery_directory, get_udm_path(file)))
+        except RasterioIOError:
+            print('UDM not found for ' + file + '. Skipping...')
+            return None
+        src = rasterio.open(os.path.join(imagery_directory, file))
+        vrt_options = {'crs': dst_crs, 'transform': transform, 'width': width, 'height': height, 'resampling': Resampling.nearest}
+        sr_offset = get_grid_offset(src, dst_crs, transform)
+        udm_offset = get_grid_offset(udm, dst_crs, transform)
+        return {
+            'file': file,
+            'src': src,
+            'udm': udm,
+            'sr_offset': sr_offset,
+            'udm_offset': udm_offset,
+            'sr_vrt': WarpedVRT(src, **vrt_options) if sr_offset is None else None,
+            'udm_vrt': WarpedVRT(udm, **vrt_options) if udm_offset is None else None,
+            'footprint': shape(transform_geom(src.crs, dst_crs, mapping(box(*src.bounds)))),
+            'view_angle': get_view_angle(file) if compositing == 'best_pixel' else 0,
+        }
 
+def close_scene(scene):
+    for key in ['sr_vrt', 'udm_vrt', 'src', 'udm']:
+        if scene[key] is not None:
+            scene[key].close()
+
+# reads a window of the output grid from a scene's SR ('sr') or UDM2 ('udm'), through its WarpedVRT if it has one
+# scenes that are already on the grid get a plain windowed read of the part of the window they cover, with 0 (nodata
+# in the SR, not clear in the UDM2) everywhere else, which is what the WarpedVRT would give
+# indexes: band number or list of band numbers, like rasterio's read; None for every band
+def read_on_grid(scene, asset, indexes, window):
+    if scene[asset + '_offset'] is None:
+        return scene[asset + '_vrt'].read(indexes, window=window)
+    dataset = scene['src'] if asset == 'sr' else scene['udm']
+    band_list = list(range(1, dataset.count + 1)) if indexes is None else ([indexes] if isinstance(indexes, int) else indexes)
+    height, width = int(window.height), int(window.width)
+    data = np.zeros((len(band_list), height, width), dtype=dataset.dtypes[0])
+
+    # the window in the dataset's own pixels, trimmed to the part the dataset covers
+    row_off = int(window.row_off) - scene[asset + '_offset'][0]
+    col_off = int(window.col_off) - scene[asset + '_offset'][1]
+    row_start, row_stop = max(row_off, 0), min(row_off + height, dataset.height)
+    col_start, col_stop = max(col_off, 0), min(col_off + width, dataset.width)
+    if row_start < row_stop and col_start < col_stop:
+        data[:, row_start - row_off:row_stop - row_off, col_start - col_off:col_stop - col_off] = dataset.read(
+            band_list, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+    return data[0] if isinstance(indexes, int) else data
+
+# makes an empty window of the mosaic: uint16 zeros if keep_integers, NaN float32s otherwise
+def new_block(window):
+    if keep_integers:
+        return np.zeros((4, int(window.height), int(window.width)), dtype='uint16')
+    return np.full((4, int(window.height), int(window.width)), np.nan, dtype='float32')
+
+# copies the picked pixels of an SR window into the mosaic, applying the scale factor unless we're keeping integers
+def put_pixels(block, sr, pick):
+    if keep_integers:
+        block[:, pick] = sr[:, pick]
+    else:
+        block[:, pick] = sr[:, pick] / 10000      # Divide by 10000 to apply scale factor
+
+# fills one window of the output grid from the scenes in priority order, only filling pixels that are still empty and
+# clear in the UDM2 (band 1). The UDM2 gets read first, and the SR is only read if there's something left to fill.
+# returns a block from new_block, with nodata wherever no scene had a clear pixel
+def paint_window(scenes, window, transform):
+    block_footprint = box(*rasterio.windows.bounds(window, transform))
+    block = new_block(window)
+    empty = np.ones((int(window.height), int(window.width)), dtype='bool')
+    for scene in scenes:
+        if not scene['footprint'].intersects(block_footprint):
+            continue
+        with instrumentation.span('reproject', asset='udm2'):
+            udm = read_on_grid(scene, 'udm', 1, window)
+        with instrumentation.span('mask'):
+            fill = empty & (udm == 1)
+        if not fill.any():
+            continue
+        with instrumentation.span('reproject', asset='sr'):
+            sr = read_on_grid(scene, 'sr', [1, 2, 3, 4], window)
+        with instrumentation.span('merge'):
+            put_pixels(block, sr, fill)
+            empty &= ~fill
+        if not empty.any():
+            break
+    return block
+
+# scores every pixel of a UDM2 window (all 8 bands) for best_pixel compositing; higher is better
+def score_udm2(udm):
+    score = np.zeros(udm.shape[1:], dtype='float32')
+    for band, flag in enumerate(['clear', 'snow', 'shadow', 'light_haze', 'heavy_haze', 'cloud']):
+        score += udm[band] * np.float32(udm2_weights[flag])
+    score += udm[6] * np.float32(udm2_weights['confidence'] / 100)
+    score[(udm[7] != 0) | ~udm[0:6].any(axis=0)] = -np.inf    # unusable, or outside the scene
+    return score
+
+# fills one window of the output grid by picking, at every pixel, the scene whose UDM2 scores best there
+# only the UDM2s of every candidate are held at once (as a stack of scores); each scene's SR is only read if it wins
+# at least one pixel in the window
+def best_pixel_window(scenes, window, transform):
+    block_footprint = box(*rasterio.windows.bounds(window, transform))
+    block = new_block(window)
+    candidates = [scene for scene in scenes if scene['footprint'].intersects(block_footprint)]
+    if len(candidates) == 0:
+        return block
+    scores = np.empty((len(candidates), int(window.height), int(window.width)), dtype='float32')
+    for i, scene in enumerate(candidates):
+        with instrumentation.span('reproject', asset='udm2'):
+            udm = read_on_grid(scene, 'udm', None, window)
+        with instrumentation.span('mask'):
+            scores[i] = score_udm2(udm) - np.float32(view_angle_weight * scene['view_angle'])
+    with instrumentation.span('merge'):
+        best = np.argmax(scores, axis=0)
+        best[np.max(scores, axis=0) <= min_pixel_score] = -1
+    for i, scene in enumerate(candidates):
+        pick = best == i
+        if pick.any():
+            with instrumentation.span('reproject', asset='sr'):
+                sr = read_on_grid(scene, 'sr', [1, 2, 3, 4], window)
+            with instrumentation.span('merge'):
+                put_pixels(block, sr, pick)
+    return block
+
+# gets the L2 output profile mosaics get written with
+def get_mosaic_profile():
+    if keep_integers:
+        return raster_output.get_profile('L2', dict({'dtype': 'uint16', 'scale': 0.0001, 'nodata': 0}, **output_profile))
+    return raster_output.get_profile('L2', output_profile)
+
+# splits the output grid up into block_size windows
+def get_blocks(width, height):
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+# works out the output grid for the AOI and opens every scene that overlaps it, in ranked order
+# returns the grid's CRS, transform, width and height, and the list of opened scenes
+def open_scenes_on_grid(list_of_imgs, epsg, clip_gdf):
+
+    # Sometimes images come in different CRS's -- this will put them all in the same one, on a grid that covers the AOI
+    dst_crs = CRS.from_string('EPSG:' + str(epsg))      # convert EPSG to CRS object
+    polygon = clip_gdf.to_crs(dst_crs).geometry.iloc[0]     # reproject the input geometry to the target CRS
+    transform, width, height = get_aoi_grid(polygon, dst_resolution)
 
-# Read in the GeoJSON file; this will be used in the mosaic function
-gdf = gpd.read_file(input_geojson).to_crs(epsg=32610)
+    # Rank the scenes by how much of the AOI they cover
+    # This process minimizes seam lines -- scenes that cover more of the ROI will be prioritized over scenes that cover less
+    with instrumentation.span('rank', scenes=len(list_of_imgs)):
+        imgs_ranked = rank_scenes(list_of_imgs, dst_crs, polygon)
 
-# takes an image and a udm2 open in rioxarray and applies the udm2 to the image using band 1 (clear/not-clear)
-def apply_udm2(img, udm):
-    img_masked = img.where(udm[0,:,:]==1, other=np.nan)
-    return img_masked
+    # Open all images in ranked order, warped onto the output grid
+    scenes = [open_scene(file, dst_crs, transform, width, height) for file in imgs_ranked]
+    scenes = [scene for scene in scenes if scene is not None]
+    return dst_crs, transform, width, height, scenes
 
 # takes a list of file paths and outputs a mosaic of all those files
 # list of images: list of file paths to images
@@ -45,102 +331,256 @@ def apply_udm2(img, udm):
 # dst_epsg: desired EPSG code of the output mosaic
 # clip_gdf: geodataframe to clip the mosaic to
 def make_mosaic(list_of_imgs, output_file_name, epsg, clip_gdf):
+    dst_crs, transform, width, height, scenes = open_scenes_on_grid(list_of_imgs, epsg, clip_gdf)
+    if len(scenes) == 0:
+        print('No scenes overlap the AOI for ' + output_file_name + '. Skipping...')
+        return
 
-    # Sometimes images come in different CRS's -- this will put them all in the same one
-    dst_crs = CRS.from_string('EPSG:' + str(epsg))      # convert EPSG to CRS object
-    gdf_crs = clip_gdf.to_crs(dst_crs)            # reproject the input geometry to the target CRS
-
-    # Open all images in the list and reproject them to the target CRS
-    imgs = []
-    for file in list_of_imgs:
-        this_img = rxr.open_rasterio(os.path.join(imagery_directory, file))
-        if (this_img.rio.crs != dst_crs):
-            this_img = this_img.rio.reproject(dst_crs)
-        udm_path = file.split('3B')[0] + '3B_udm2_clip.tif'     # 3B is the code for the analytic SR data product
-        try:
-            this_udm = rxr.open_rasterio(os.path.join(imagery_directory, udm_path))
-        except:
-            print('UDM not found for ' + file + '. Skipping...')
-            continue
-        if (this_udm.rio.crs != dst_crs):
-            this_udm = this_udm.rio.reproject(dst_crs)
-        imgs.append(apply_udm2(this_img, this_udm))
-
-    # Check percentage overlap between the polygon and the rasters
-    # This process minimizes seam lines -- scenes that cover more of the ROI will be prioritized over scenes that cover less
-    polygon = gdf_crs.geometry.iloc[0]
-    num_pixels = []
-    for raster in imgs:
-        # Counts pixels that overlap with the polygon
-        num_pixels.append(np.count_nonzero(raster.rio.clip([polygon], gdf_crs.crs, drop=False).values[0,:,:]))
-
-    # Sort imgs bassed on how many pixels they have that overlaps with the GDF
-    # merge_arrays uses a reverse painters algorithm to make the mosaic, so they need to be in the correct order
-    imgs_sorted = [x for _,x in sorted(zip(num_pixels, imgs), key=lambda pair:pair[0])]
-    imgs_sorted.reverse()
-
-    # Make mosaic...
-    this_mosaic = merge_arrays(imgs_sorted, nodata=np.nan)
-
-    # Divide by 10000 to apply scale factor
-    this_mosaic = this_mosaic/10000
-
-    # Convert DataArray to Dataset so that we can save out the multi-band rasters
+    # Make mosaic and save it out as a tiled, compressed COG using the L2 output profile
+    make_window = best_pixel_window if compositing == 'best_pixel' else paint_window
     bands = ['R', 'G', 'B', 'NIR']
-    output = xa.Dataset()
-    for bandnum, band in enumerate(bands):
-        output[band] = this_mosaic[bandnum,:,:]
-
-    output.rio.to_raster(output_file_name)
-
-
-
-# lists out SR images in the input directory
-all_imgs = [filename for filename in os.listdir(imagery_directory) if filename.endswith('harmonized_clip.tif')]
-
-# list out dates that we have imagery for
-dates = [filename.split('_')[0] for filename in all_imgs]
-dates = list(set(dates))
-
-
-
-# Check which dates we already have mosaics for
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-existing_files = os.listdir(output_directory)
-existing_dates = [file.split('.')[0] for file in existing_files]
-existing_dates = list(set(existing_dates))
-date_list = [date for date in dates if date not in existing_dates]
-
-if len(date_list) == 0:
-    print('No new dates to make mosaics for. Exiting...')
-    exit()
-if len(date_list) == len(dates):
-    print('Making mosaics for ' + str(len(date_list)) + ' dates...')
-else:
-    print('Skipping ' + str(len(dates) - len(date_list)) + ' dates that already have mosaics. Making mosaics for ' + str(len(date_list)) + ' dates...')
-
-# make mosaics for all dates in date_list
-for count, date in enumerate(date_list):
-    print(str(datetime.datetime.now().time()) + '    Working on ' + date + ' (' + str(count+1) + ' of ' + str(len(date_list)) + ')...')
-    # filter out images that aren't from this date
-    this_date_files = [filename for filename in os.listdir(imagery_directory) if filename.startswith(date)]
-    if len(this_date_files)==0:
-        continue
-    # get only the SR images
-    this_date_images = [os.path.join(imagery_directory,filename) for filename in this_date_files if filename.endswith('harmonized_clip.tif')]
-    # save out metadata to a json file
-    metadata_dict = {
+    profile = get_mosaic_profile()
+    try:
+        if streaming:
+            dst = raster_output.open_streaming_output(output_file_name, 4, height, width, dst_crs, transform, profile, bands)
+            for window in get_blocks(width, height):
+                block = make_window(scenes, window, transform)
+                with instrumentation.span('write'):
+                    raster_output.write_window(dst, block, window, profile, encoded=keep_integers)
+            with instrumentation.span('write', file=os.path.basename(output_file_name), cog=True):
+                raster_output.finish_streaming_output(dst, output_file_name, profile)
+        else:
+            this_mosaic = make_window(scenes, Window(0, 0, width, height), transform)
+            with instrumentation.span('write', file=os.path.basename(output_file_name), cog=True):
+                raster_output.write_cog(this_mosaic, output_file_name, dst_crs, transform, profile, bands, encoded=keep_integers)
+    finally:
+        for scene in scenes:
+            close_scene(scene)
+
+# adds new scenes to an existing mosaic, only repainting the blocks that one of the new scenes overlaps
+# Each block is always painted from every scene for the date, and a scene's rank doesn't depend on the other scenes, so
+# the patched mosaic comes out the same as rebuilding it from scratch
+# list of images: every image for the date, old and new
+# new_imgs: the images that aren't in the existing mosaic yet
+# Falls back to make_mosaic if the existing mosaic can't be read or isn't on the grid and profile a new one would be made with
+def patch_mosaic(list_of_imgs, new_imgs, output_file_name, epsg, clip_gdf):
+    dst_crs, transform, width, height, scenes = open_scenes_on_grid(list_of_imgs, epsg, clip_gdf)
+    profile = get_mosaic_profile()
+    try:
+        try:
+            with rasterio.open(output_file_name) as existing:
+                same_grid = (existing.crs == dst_crs and existing.transform == transform and existing.shape == (height, width)
+                             and existing.count == 4 and existing.dtypes[0] == profile['dtype'])
+        except RasterioIOError:
+            same_grid = False
+        if not same_grid:
+            print('Existing mosaic ' + output_file_name + ' is missing, unreadable, or on a different grid or profile; rebuilding it...')
+            return make_mosaic(list_of_imgs, output_file_name, epsg, clip_gdf)
+
+        new_footprints = [scene['footprint'] for scene in scenes if scene['file'] in new_imgs]
+        windows = [window for window in get_blocks(width, height)
+                   if any(footprint.intersects(box(*rasterio.windows.bounds(window, transform))) for footprint in new_footprints)]
+        if len(windows) == 0:
+            print('None of the new scenes overlap the AOI for ' + output_file_name + '; nothing to patch.')
+            return
+
+        # Copy the existing COG into a tiled GeoTIFF that can be written to window-by-window, repaint, and re-COG it
+        print('Repainting ' + str(len(windows)) + ' of ' + str(len(list(get_blocks(width, height)))) + ' blocks of ' + output_file_name + '...')
+        make_window = best_pixel_window if compositing == 'best_pixel' else paint_window
+        # A mosaic that opens but is damaged (e.g. truncated) fails here, when its blocks get read
+        try:
+            rasterio.shutil.copy(output_file_name, raster_output.get_streaming_path(output_file_name), driver='GTiff', tiled=True,
+                                 blockxsize=profile['blocksize'], blockysize=profile['blocksize'], compress=profile['compress'],
+                                 predictor=raster_output.get_predictor(profile), bigtiff='IF_SAFER')
+        except Exception as e:
+            print('Could not read existing mosaic ' + output_file_name + ' (' + repr(e) + '); rebuilding it...')
+            return make_mosaic(list_of_imgs, output_file_name, epsg, clip_gdf)
+        dst = rasterio.open(raster_output.get_streaming_path(output_file_name), 'r+')
+        for window in windows:
+            block = make_window(scenes, window, transform)
+            with instrumentation.span('write'):
+                raster_output.write_window(dst, block, window, profile, encoded=keep_integers)
+        with instrumentation.span('write', file=os.path.basename(output_file_name), cog=True):
+            raster_output.finish_streaming_output(dst, output_file_name, profile)
+    finally:
+        for scene in scenes:
+            close_scene(scene)
+
+# scene IDs recorded in a file list, e.g. the scenes of a date in its metadata file
+def get_item_ids(list_of_imgs):
+    return set(scene_catalog.get_item_id(os.path.basename(file)) for file in list_of_imgs)
+
+# settings that go into a mosaic; if any of these change, existing mosaics get rebuilt in incremental mode
+def get_mosaic_settings():
+    return {'epsg': dst_epsg, 'geojson_used': input_geojson, 'resolution': dst_resolution, 'compositing': compositing, 'keep_integers': keep_integers}
+
+# compares an existing mosaic's metadata file with the scenes the catalog has for its date
+# returns 'up to date', 'patch' (scenes have only been added) or 'rebuild', along with the images that are new
+def check_existing_mosaic(date, this_date_images):
+    try:
+        with open(os.path.join(output_directory, date + '_metadata.json')) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return 'rebuild', this_date_images
+    if 'scenes' not in metadata or any(key in metadata and metadata[key] != value for key, value in get_mosaic_settings().items()):
+        return 'rebuild', this_date_images
+    recorded_ids = get_item_ids(metadata['scenes'])
+    current_ids = get_item_ids(this_date_images)
+    if recorded_ids == current_ids:
+        return 'up to date', []
+    if not recorded_ids <= current_ids:
+        return 'rebuild', this_date_images
+    return 'patch', [file for file in this_date_images if scene_catalog.get_item_id(os.path.basename(file)) not in recorded_ids]
+
+
+
+# rough estimate of the peak memory (in MB) needed to build one date's mosaic
+# the working set is about 42 bytes per output pixel (a block of SR and UDM2 reads, the float32 mosaic and its encoded
+# copy; about 18 with keep_integers), for the whole AOI grid or for one block in streaming mode. On top of that, each worker has a fixed overhead
+# (Python, GDAL cache, warp buffers), and each scene costs a little for its open datasets and VRTs plus a bit more the
+# bigger it is. best_pixel compositing also holds a float32 score and an 8-band UDM2 window per scene.
+# grid_pixels: number of pixels in the AOI grid
+# scene_sizes: size in bytes of each scene's SR file
+def estimate_memory_mb(grid_pixels, scene_sizes):
+    working_pixels = min(grid_pixels, block_size**2) if streaming else grid_pixels
+    bytes_per_pixel = (18 if keep_integers else 42) + (4 * len(scene_sizes) + 8 if compositing == 'best_pixel' else 0)
+    return 300 + gdal_cache_mb + working_pixels * bytes_per_pixel / 1024**2 + sum(8 + 0.01 * size / 1024**2 for size in scene_sizes)
+
+# AOI geometry, read once per worker process
+clip_gdf = None
+
+# sets up a worker process
+def init_worker():
+    os.environ['GDAL_CACHEMAX'] = str(gdal_cache_mb)
+
+# builds the mosaic for one date, along with its metadata file; this is the unit of work handed to each worker
+# new_images: if given, the existing mosaic only gets patched with these scenes rather than rebuilt
+def build_date(date, this_date_images, new_images=None):
+    global clip_gdf
+    if clip_gdf is None:
+        clip_gdf = gpd.read_file(input_geojson).to_crs(epsg=32610)
+    # make the mosaic
+    with instrumentation.span('mosaic_date', date=date, scenes=len(this_date_images), patch=new_images is not None):
+        if new_images is None:
+            make_mosaic(this_date_images, os.path.join(output_directory, date + '.tif'), dst_epsg, clip_gdf)
+        else:
+            patch_mosaic(this_date_images, new_images, os.path.join(output_directory, date + '.tif'), dst_epsg, clip_gdf)
+    # save out metadata to a json file; this only happens once the mosaic is done, so a date that fails partway through
+    # never gets recorded as having all its scenes in it
+    metadata_dict = dict({
         'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         'source_dir': imagery_directory,
         'scenes': this_date_images,
-        'epsg': dst_epsg,
-        'geojson_used': input_geojson
-        }
+        }, **get_mosaic_settings())
     with open(os.path.join(output_directory, date + '_metadata.json'), 'w') as outfile:
         json.dump(metadata_dict, outfile)
-    # make the mosaic
-    make_mosaic(this_date_images, os.path.join(output_directory, date + '.tif'), dst_epsg, gdf)
 
 
 
+# Everything below only runs when this is run as a script, so the functions above can be imported (e.g. for benchmarking)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Makes daily mosaics (L2) from a directory of PlanetScope scenes (L1)')
+    parser.add_argument('--workers', type=int, default=workers, help='number of processes to build dates with')
+    parser.add_argument('--ram-budget-mb', type=int, default=ram_budget_mb, help='total memory the running dates are allowed to need')
+    args = parser.parse_args()
+
+    # Read in the GeoJSON file; this will be used in the mosaic function
+    gdf = gpd.read_file(input_geojson).to_crs(epsg=32610)
+
+    # Bring the scene catalog up to date; this is the only time the imagery directory gets listed
+    catalog = scene_catalog.open_catalog(catalog_path)
+    with instrumentation.span('catalog_refresh'):
+        scene_catalog.refresh_catalog(catalog, imagery_directory, compute_checksums)
+
+    # list out dates that we have imagery for
+    dates = scene_catalog.get_dates(catalog)
+
+
+
+    # Check which dates we already have mosaics for
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    existing_dates = set(file[:-len('.tif')] for file in os.listdir(output_directory) if file.endswith('.tif'))
+
+    # Work out what each date needs to be built, and roughly how much memory that will take
+    # In incremental mode, dates that already have a mosaic get checked against the catalog and only redone if their
+    # scenes have changed
+    polygon = gdf.to_crs(CRS.from_string('EPSG:' + str(dst_epsg))).geometry.iloc[0]
+    grid_transform, grid_width, grid_height = get_aoi_grid(polygon, dst_resolution)
+    jobs = []
+    num_skipped = 0
+    num_patched = 0
+    for date in dates:
+        scenes = scene_catalog.get_scenes_for_date(catalog, date)
+        if len(scenes) == 0:
+            continue
+        images = [scene['sr_path'] for scene in scenes]
+        new_images = None
+        if date in existing_dates:
+            status, changed_images = check_existing_mosaic(date, images) if incremental else ('up to date', [])
+            if status == 'up to date':
+                num_skipped += 1
+                continue
+            if status == 'patch':
+                new_images = changed_images
+                num_patched += 1
+        jobs.append({
+            'date': date,
+            'images': images,
+            'new_images': new_images,
+            'memory_mb': estimate_memory_mb(grid_width * grid_height, [scene['size'] for scene in scenes]),
+        })
+    catalog.close()
+
+    if len(jobs) == 0:
+        print('No new dates to make mosaics for. Exiting...')
+        exit()
+    print('Skipping ' + str(num_skipped) + ' dates whose mosaics are up to date. Making mosaics for ' + str(len(jobs)) + ' dates (' + str(num_patched) + ' by patching in new scenes)...')
+
+    # make mosaics for all dates in date_list
+    # A failure on one date gets reported but doesn't stop the rest of the run
+    failures = []
+    if args.workers <= 1:
+        init_worker()
+        for count, job in enumerate(jobs):
+            print(str(datetime.datetime.now().time()) + '    Working on ' + job['date'] + ' (' + str(count+1) + ' of ' + str(len(jobs)) + ')...')
+            try:
+                build_date(job['date'], job['images'], job['new_images'])
+            except Exception:
+                print(str(datetime.datetime.now().time()) + '    Failed to make mosaic for ' + job['date'] + ':')
+                traceback.print_exc()
+                failures.append(job['date'])
+    else:
+        # Biggest dates get admitted first, then smaller ones fill in around them
+        pending = sorted(jobs, key=lambda job: job['memory_mb'], reverse=True)
+        running = {}
+        finished = 0
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                # Admit as many dates as fit in the memory budget and the free workers
+                # A date bigger than the whole budget still runs, but only when nothing else is running
+                memory_in_use = sum(job['memory_mb'] for job in running.values())
+                for job in list(pending):
+                    if len(running) >= args.workers:
+                        break
+                    if memory_in_use + job['memory_mb'] <= args.ram_budget_mb or len(running) == 0:
+                        if job['memory_mb'] > args.ram_budget_mb:
+                            print(str(datetime.datetime.now().time()) + '    ' + job['date'] + ' needs about ' + str(int(job['memory_mb'])) + ' MB, which is more than the budget; running it on its own...')
+                        running[executor.submit(build_date, job['date'], job['images'], job['new_images'])] = job
+                        memory_in_use += job['memory_mb']
+                        pending.remove(job)
+
+                # Wait for something to finish, then report on it
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    finished += 1
+                    try:
+                        future.result()
+                        print(str(datetime.datetime.now().time()) + '    Finished ' + job['date'] + ' (' + str(finished) + ' of ' + str(len(jobs)) + ', ~' + str(int(sum(running_job['memory_mb'] for running_job in running.values()))) + ' MB of ' + str(args.ram_budget_mb) + ' MB budget in use)')
+                    except Exception as e:
+                        print(str(datetime.datetime.now().time()) + '    Failed to make mosaic for ' + job['date'] + ': ' + repr(e))
+                        failures.append(job['date'])
+
+    if len(failures) > 0:
+        print(str(len(failures)) + ' dates failed: ' + ', '.join(sorted(failures)))
@@ -0,0 +1,170 @@
+### This script summarizes L3 index rasters per reserve (mean, median, percentiles, valid pixel counts) into one table
+### Each reserve polygon is only rasterized once per output grid; the label raster gets cached on disk and reused for
+### every date and index on that grid
+
+
+
+# Directory of reserve boundaries; every .geojson in here is a zone
+reserves_directory = '../basemaps/bounds/geojsons/UCNRS'
+
+# Directory of derived products made by make_derived_products.py
+indices_directory = 'E:/sedgwick_reserve/L3_indices'
+
+# Indices to summarize
+indices = ['ndvi', 'ndwi', 'msavi2', 'mtvi2', 'vari', 'tgi']
+
+# Percentiles to include in the table (the median is always included)
+percentiles = [10, 25, 75, 90]
+
+# CSV file to save the table to; if it already exists, only dates and indices that aren't in it yet get added
+output_file = 'E:/sedgwick_reserve/zonal_stats.csv'
+
+# Directory to cache rasterized reserve labels in
+label_cache_directory = 'E:/sedgwick_reserve/L3_indices/zonal_labels'
+
+
+
+# Import packages
+import datetime
+import hashlib
+import json
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+
+
+# Every reserve, in a fixed order; a reserve's label is its position in this list + 1 (0 means no reserve)
+reserve_files = sorted([file for file in os.listdir(reserves_directory) if file.endswith('.geojson')])
+reserve_names = [file[:-len('.geojson')] for file in reserve_files]
+
+# Label rasters already loaded during this run, by grid key
+label_cache = {}
+
+
+# Key for a grid; rasters with the same key can share a label raster
+def get_grid_key(src):
+    grid = [src.crs.to_wkt(), list(src.transform)[:6], src.height, src.width, reserve_files]
+    return hashlib.sha1(json.dumps(grid).encode()).hexdigest()[:16]
+
+
+# Gets the label raster for the grid of an open raster, cropped to the smallest window that covers every reserve
+# Returns (window, labels), or (None, None) if no reserve touches the grid
+# Label rasters are made once per grid and cached both in memory and on disk
+def get_labels(src):
+    grid_key = get_grid_key(src)
+    if grid_key in label_cache:
+        return label_cache[grid_key]
+
+    cache_path = os.path.join(label_cache_directory, grid_key + '.npz')
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        labels = cached['labels']
+    else:
+        shapes = []
+        for label, file in enumerate(reserve_files):
+            gdf = gpd.read_file(os.path.join(reserves_directory, file)).to_crs(src.crs)
+            shapes.extend([(geometry, label + 1) for geometry in gdf.geometry])
+        labels = rasterize(shapes, out_shape=src.shape, transform=src.transform, fill=0, dtype='uint16')
+        if not os.path.exists(label_cache_directory):
+            os.makedirs(label_cache_directory)
+        np.savez_compressed(cache_path, labels=labels)
+
+    rows = np.nonzero(labels.any(axis=1))[0]
+    cols = np.nonzero(labels.any(axis=0))[0]
+    if len(rows) == 0:
+        label_cache[grid_key] = (None, None)
+    else:
+        window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        label_cache[grid_key] = (window, labels[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+    return label_cache[grid_key]
+
+
+# Works out every statistic for every reserve in one pass over a raster
+# values, labels: 2D arrays of the same shape
+# Returns a list of table rows, one per reserve that touches the raster
+def get_zonal_stats(values, labels):
+    num_labels = len(reserve_files) + 1
+    labels = labels.ravel()
+    values = values.ravel()
+    total_pixels = np.bincount(labels, minlength=num_labels)
+    valid = np.isfinite(values) & (labels > 0)
+    labels = labels[valid]
+    values = values[valid]
+    valid_pixels = np.bincount(labels, minlength=num_labels)
+    sums = np.bincount(labels, weights=values, minlength=num_labels)
+
+    # Sort by reserve and then by value, so each reserve's values are one sorted run; percentiles are then just
+    # (interpolated) lookups at fixed positions in each run, for every reserve at once
+    order = np.lexsort((values, labels))
+    sorted_values = values[order]
+    starts = np.concatenate([[0], np.cumsum(valid_pixels)[:-1]])
+    has_values = valid_pixels > 0
+
+    def get_percentile(q):
+        position = starts + (q / 100) * np.maximum(valid_pixels - 1, 0)
+        lower = np.floor(position).astype('int64')
+        upper = np.ceil(position).astype('int64')
+        fraction = position - lower
+        result = np.full(num_labels, np.nan)
+        result[has_values] = sorted_values[lower[has_values]] * (1 - fraction[has_values]) + sorted_values[upper[has_values]] * fraction[has_values]
+        return result
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / valid_pixels
+    medians = get_percentile(50)
+    other_percentiles = {q: get_percentile(q) for q in percentiles}
+
+    rows = []
+    for label in np.nonzero(total_pixels[1:])[0] + 1:
+        row = {
+            'Reserve': reserve_names[label - 1],
+            'Total_Pixels': int(total_pixels[label]),
+            'Valid_Pixels': int(valid_pixels[label]),
+            'Mean': means[label],
+            'Median': medians[label],
+        }
+        for q in percentiles:
+            row['P' + str(q)] = other_percentiles[q][label]
+        rows.append(row)
+    return rows
+
+
+
+if __name__ == '__main__':
+    # Check which dates and indices are already in the table
+    if os.path.exists(output_file):
+        existing = pd.read_csv(output_file, dtype={'Date': str})
+        done = set(zip(existing['Date'], existing['Index']))
+    else:
+        existing = None
+        done = set()
+
+    new_rows = []
+    for index in indices:
+        files = sorted([file for file in os.listdir(os.path.join(indices_directory, index)) if file.endswith('_' + index + '.tif')])
+        files = [file for file in files if (file[:-len('_' + index + '.tif')], index) not in done]
+        print(str(datetime.datetime.now().time()) + '    Summarizing ' + index.upper() + ' for ' + str(len(files)) + ' dates...')
+        for file in files:
+            date = file[:-len('_' + index + '.tif')]
+            with rasterio.open(os.path.join(indices_directory, index, file)) as src:
+                window, labels = get_labels(src)
+                if window is None:
+                    continue
+                values = src.read(1, window=window, masked=True).astype('float32').filled(np.nan)
+                values = values * src.scales[0] + src.offsets[0]
+            for row in get_zonal_stats(values, labels):
+                new_rows.append(dict({'Date': date, 'Index': index}, **row))
+
+    if len(new_rows) == 0:
+        print('Zonal stats are already up to date.')
+    else:
+        table = pd.DataFrame(new_rows)
+        if existing is not None:
+            table = pd.concat([existing, table], ignore_index=True)
+        table = table.sort_values(by=['Index', 'Reserve', 'Date'])
+        table.to_csv(output_file, index=False)
+        print('Added ' + str(len(new_rows)) + ' rows to ' + output_file + '.')
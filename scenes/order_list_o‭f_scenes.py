@@ -11,6 +11,22 @@ geojson_path = 'E:/coal_oil_point/Coal_Oil_Point_Natural_Reserve_bb.geojson'
 # Directory to download imagery to
 output_directory = 'E:/coal_oil_point/L1_harmonized_scenes'
 
+# Catalog of the scenes already in the output directory (the same catalog make_mosaic.py uses)
+catalog_path = 'E:/coal_oil_point/L1_harmonized_scenes/scene_catalog.sqlite'
+
+# Extra processing Planet can do before delivery, on top of clipping to the AOI and harmonizing to Sentinel-2
+# reproject_epsg, reproject_resolution: reproject every scene (and its UDM2) to this EPSG code and resolution in meters,
+#     e.g. make_mosaic.py's dst_epsg and dst_resolution. When the scenes arrive lined up with make_mosaic.py's grid it
+#     reads them directly instead of warping them. None leaves scenes in their own UTM zone.
+# composite: have Planet composite each day's scenes into one image, with one order per day; these get saved as
+#     <date>_composite_3B_AnalyticMS_SR_harmonized_clip.tif (and a matching UDM2) so the rest of the pipeline treats
+#     them like any other scene
+# file_format: 'COG' to get Cloud-Optimized GeoTIFFs, or None for Planet's default GeoTIFFs
+reproject_epsg = None
+reproject_resolution = 3
+composite = False
+file_format = None
+
 
 
 # Import packages
@@ -20,6 +36,8 @@ import os
 import requests
 import time
 import pandas as pd
+import instrumentation
+import scene_catalog
 from requests.auth import HTTPBasicAuth
 
 # Read in the CSV file containing the list of image IDs
@@ -31,19 +49,54 @@ with open(geojson_path) as f:
     geometry = json.load(f)
 
 
-# Takes in list of image ID strings, outputs download link
+# Gets the tools to run on an order, based on the settings at the top of this script
+def get_order_tools():
+    tools = [
+        {
+            "clip": {
+                "aoi": {
+                    "type": "Polygon",
+                    "coordinates": geometry['features'][0]['geometry']['coordinates']
+                }
+            }
+        },
+        {
+            "harmonize": {
+                "target_sensor": "Sentinel-2"
+            }
+        }
+    ]
+    if reproject_epsg is not None:
+        tools.append({"reproject": {"projection": "EPSG:" + str(reproject_epsg), "resolution": reproject_resolution, "kernel": "near"}})
+    if composite:
+        tools.append({"composite": {}})
+    if file_format is not None:
+        tools.append({"file_format": {"format": file_format}})
+    return tools
+
+
+# Takes in list of image ID strings, outputs a list of download links (one per order)
 def order_list_of_imgs(id_list, order_name='List of Images Order'):
-    # Check which dates we already have imagery for
+    # Check which images we already have; this matches full item IDs, so two satellites imaging in the same second don't collide
+    # Composited days are in the catalog as <date>_composite rather than by their scenes' IDs
     original_length = len(id_list)
-    existing_files = os.listdir(output_directory)
-    existing_datetimes = ['_'.join(file.split('_')[0:2]) for file in existing_files]  # makes list of dates and times for which we already have imagery
-    existing_datetimes = list(set(existing_datetimes))  # gets only unique dates and times
-    id_list = [id for id in id_list if id[0:15] not in existing_datetimes]
+    catalog = scene_catalog.open_catalog(catalog_path)
+    with instrumentation.span('catalog_refresh'):
+        scene_catalog.refresh_catalog(catalog, output_directory)
+    id_list = [id for id in id_list if not scene_catalog.has_item(catalog, id) and not scene_catalog.has_item(catalog, id[:8] + '_composite')]
+    catalog.close()
     if len(id_list) < original_length:
         print('Found ' + str(original_length - len(id_list)) + ' images that already exist in the output directory. Skipping...')
     if len(id_list) == 0:
         print('No new images to download. Exiting...')
-        return
+        return []
+    dates = sorted(set(id[:8] for id in id_list))
+    if composite and len(dates) > 1:
+        print('Compositing ' + str(len(id_list)) + ' images from ' + str(len(dates)) + ' days. Making one order per day...')
+        order_links = []
+        for date in dates:
+            order_links.extend(order_list_of_imgs([id for id in id_list if id[:8] == date], order_name=order_name + ' ' + date))
+        return order_links
     if len(id_list) > 500:
         print('Org is limited to 500 bundles per order, but you have ' + str(len(id_list)) + ' images. Splitting into multiple orders...')
         num_orders = int(len(id_list)/500) + 1
@@ -51,7 +104,7 @@ def order_list_of_imgs(id_list, order_name='List of Images Order'):
         for i in range(num_orders):
             print('Ordering bundle ' + str(i+1) + ' of ' + str(num_orders) + '...')
             this_order = order_list_of_imgs(id_list[500*i:500*(i+1)], order_name=order_name)
-            order_links.append(this_order)
+            order_links.extend(this_order)
         return order_links
     print('Ordering ' + str(len(id_list)) + ' images...')
     # Order body to be sent over HTTP request
@@ -65,62 +118,76 @@ def order_list_of_imgs(id_list, order_name='List of Images Order'):
                 "product_bundle":"analytic_sr_udm2"
             }
         ],
-            "tools": [
-            {
-                "clip": {
-                    "aoi": {
-                        "type": "Polygon",
-                        "coordinates": geometry['features'][0]['geometry']['coordinates']
-                    }
-                    },         
-            },
-            {
-                "harmonize": {
-                    "target_sensor":  "Sentinel-2"
-                }, 
-            }
-            ]
+        "tools": get_order_tools()
     }
-    result = \
-        requests.post(
-        'https://api.planet.com/compute/ops/orders/v2',
-        auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''),
-        json=request_body)
+    with instrumentation.span('api_request', endpoint='orders', items=len(id_list)) as s:
+        result = \
+            requests.post(
+            'https://api.planet.com/compute/ops/orders/v2',
+            auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''),
+            json=request_body)
+        s['status'] = result.status_code
     return [result.json()['_links']['_self']]
 
 
+# Gets the current status of an order
+def poll_order(link):
+    with instrumentation.span('order_poll') as s:
+        result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+        s['status'] = result.status_code
+    return result
+
+
 # Get the state of an order using the link
 # Possible values: queued, running, success, partial, failed, cancelled
 def check_on_order(link):
-    result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+    result = poll_order(link)
     return result.json()['state']
 
 
+# Composites come back as composite.tif, composite_udm2.tif, etc.; these get renamed after their date and given the same
+# file name endings as a scene, e.g. 20230628_composite_3B_AnalyticMS_SR_harmonized_clip.tif
+def get_composite_filename(filename, date):
+    if filename == 'composite.tif':
+        return date + '_composite_3B_AnalyticMS_SR_harmonized_clip.tif'
+    if filename == 'composite_udm2.tif':
+        return date + '_composite_3B_udm2_clip.tif'
+    if filename.startswith('composite'):
+        return date + '_' + filename
+    return filename
+
+
 # Downloads all scenes at a given search result link to the local directory
 def order_all_scenes(link):
-    result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], '')).json()
+    with instrumentation.span('api_request', endpoint='order results'):
+        result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], '')).json()
     files = result['_links']['results']
     for file in files:
         filename = file['name'].split('/')[-1]
+        if composite:
+            filename = get_composite_filename(filename, result['products'][0]['item_ids'][0][:8])
         print(str(datetime.datetime.now().time()) + '    ' + 'Downloading ' + filename + '...')
-        r = requests.get(file['location'], auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
-        with open(os.path.join(output_directory,filename),'wb') as f:
-            f.write(r.content)
+        with instrumentation.span('download', file=filename) as s:
+            r = requests.get(file['location'], auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+            s['bytes'] = len(r.content)
+        with instrumentation.span('write', file=filename):
+            with open(os.path.join(output_directory,filename),'wb') as f:
+                f.write(r.content)
 
 # Waits for an order to be ready and then starts downloading imagery
 def download_order(link):
-    result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+    result = poll_order(link)
     state = result.json()['state']
     isDone = False
     while isDone==False:
         if state=='queued':
             print(str(datetime.datetime.now().time()) + '    ' + 'Order queued. Waiting for processing to begin...')
             time.sleep(1)
-            result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+            result = poll_order(link)
             state = result.json()['state']
         elif state=='running':
             try:
-                result = requests.get(link, auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''))
+                result = poll_order(link)
                 print(str(datetime.datetime.now().time()) + '    ' + str(result.json()['last_message'])+'...')
             except KeyError: # sometimes state isn't in the returned json for some reason
                 print(str(datetime.datetime.now().time()) + '    ' + 'Order running...')
@@ -156,4 +223,4 @@ if len(list_of_download_links) > 3:
 
 for count, link in enumerate(list_of_download_links):
     print(str(datetime.datetime.now().time()) + '    STARTING ORDER #' + str(count+1) + ' OF ' + str(len(list_of_download_links)))
-    download_order(link[0])
\ No newline at end of file
+    download_order(link)
\ No newline at end of file
@@ -0,0 +1,190 @@
+### Output profiles for L2 mosaics and L3 derived products
+### Everything gets written as a tiled, compressed Cloud-Optimized GeoTIFF with overviews
+### Used by make_mosaic.py and make_derived_products.py
+
+
+
+# Import packages
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+
+# Default profile for each product level. Scripts can override any of these per product (e.g. per index).
+# dtype: 'float32', or an integer type like 'int16'/'uint16' to store values scaled by 1/scale
+# scale: stored values are multiplied by this on read (written to the GeoTIFF as scale metadata); only used for integer dtypes
+# nodata: nodata value; NaN for floats, something out of range (e.g. -32768) for integers
+# compress: 'DEFLATE' works everywhere; 'ZSTD' is faster and smaller but needs a GDAL built with it
+# blocksize: size of the internal tiles in pixels
+# overview_resampling: resampling used to build the overviews
+output_profiles = {
+    'L2': {
+        'dtype': 'float32',
+        'scale': 1,
+        'nodata': np.nan,
+        'compress': 'DEFLATE',
+        'level': 6,
+        'blocksize': 512,
+        'overview_resampling': 'AVERAGE',
+    },
+    'L3': {
+        'dtype': 'float32',
+        'scale': 1,
+        'nodata': np.nan,
+        'compress': 'DEFLATE',
+        'level': 6,
+        'blocksize': 512,
+        'overview_resampling': 'AVERAGE',
+    },
+}
+
+
+# Gets the profile for a product level with any overrides applied on top
+# level: 'L2' or 'L3'
+# overrides: dict of profile keys to change, e.g. {'dtype': 'int16', 'scale': 0.0001, 'nodata': -32768}
+def get_profile(level, overrides=None):
+    profile = dict(output_profiles[level])
+    if overrides:
+        profile.update(overrides)
+    if np.dtype(profile['dtype']).kind == 'f':
+        profile['scale'] = 1
+    return profile
+
+
+# Floating point predictor for floats, horizontal differencing for integers
+def get_predictor(profile):
+    return 3 if np.dtype(profile['dtype']).kind == 'f' else 2
+
+
+# Turns physical values (with NaN as nodata) into what actually gets stored on disk for a given profile
+def encode(data, profile):
+    if np.dtype(profile['dtype']).kind == 'f':
+        return data.astype(profile['dtype'])
+    info = np.iinfo(profile['dtype'])
+    low = info.min + 1 if profile['nodata'] == info.min else info.min     # keep real values from clipping onto nodata
+    high = info.max - 1 if profile['nodata'] == info.max else info.max
+    with np.errstate(invalid='ignore'):
+        stored = np.clip(np.round(data / profile['scale']), low, high)
+    stored[~np.isfinite(data)] = profile['nodata']
+    return stored.astype(profile['dtype'])
+
+
+# Copies the scale factor and band names into an open dataset
+def set_band_metadata(dst, profile, band_descriptions=None):
+    dst.scales = [profile['scale']] * dst.count
+    dst.offsets = [0] * dst.count
+    if band_descriptions is not None:
+        dst.descriptions = band_descriptions
+
+
+# Writes an in-memory array (bands, rows, cols) or (rows, cols) straight out as a COG
+# data: physical values, with NaN wherever there's no data
+# encoded: data is already in the profile's dtype, scaled and with its nodata value (e.g. uint16 mosaics), so write it as-is
+def write_cog(data, output_path, crs, transform, profile, band_descriptions=None, encoded=False):
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+    with rasterio.open(
+        output_path,
+        'w',
+        driver='COG',
+        count=data.shape[0],
+        height=data.shape[1],
+        width=data.shape[2],
+        dtype=profile['dtype'],
+        nodata=profile['nodata'],
+        crs=crs,
+        transform=transform,
+        compress=profile['compress'],
+        level=profile['level'],
+        predictor=get_predictor(profile),
+        blocksize=profile['blocksize'],
+        overviews='AUTO',
+        overview_resampling=profile['overview_resampling'],
+        bigtiff='IF_SAFER',
+    ) as dst:
+        dst.write(data if encoded else encode(data, profile))
+        set_band_metadata(dst, profile, band_descriptions)
+
+
+# The COG driver can't be written to window-by-window, so streaming outputs get written to a tiled, compressed GeoTIFF
+# first and then copied into a COG by finish_streaming_output. The copy works through the file a tile at a time.
+def get_streaming_path(output_path):
+    return output_path + '.stream.tmp'
+
+
+# Opens a tiled GeoTIFF that can be written window-by-window with write_window
+def open_streaming_output(output_path, count, height, width, crs, transform, profile, band_descriptions=None):
+    dst = rasterio.open(
+        get_streaming_path(output_path),
+        'w',
+        driver='GTiff',
+        count=count,
+        height=height,
+        width=width,
+        dtype=profile['dtype'],
+        nodata=profile['nodata'],
+        crs=crs,
+        transform=transform,
+        tiled=True,
+        blockxsize=profile['blocksize'],
+        blockysize=profile['blocksize'],
+        compress=profile['compress'],
+        predictor=get_predictor(profile),
+        bigtiff='IF_SAFER',
+    )
+    set_band_metadata(dst, profile, band_descriptions)
+    return dst
+
+
+# Writes physical values to one window of a dataset opened with open_streaming_output
+def write_window(dst, data, window, profile, indexes=None, encoded=False):
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+    dst.write(data if encoded else encode(data, profile), indexes=indexes or list(range(1, data.shape[0] + 1)), window=window)
+
+
+# Closes a streaming output and turns it into a COG at output_path
+# The COG gets copied to a temporary file and only moved over output_path once it's complete, so an interrupted copy
+# never leaves a truncated file in place of a good one (e.g. a mosaic being patched)
+def finish_streaming_output(dst, output_path, profile):
+    dst.close()
+    finished_path = output_path + '.cog.tmp'
+    try:
+        rasterio.shutil.copy(
+            get_streaming_path(output_path),
+            finished_path,
+            driver='COG',
+            compress=profile['compress'],
+            level=profile['level'],
+            predictor=get_predictor(profile),
+            blocksize=profile['blocksize'],
+            overviews='AUTO',
+            overview_resampling=profile['overview_resampling'],
+            bigtiff='IF_SAFER',
+        )
+    except:
+        if os.path.exists(finished_path):
+            os.remove(finished_path)
+        raise
+    os.replace(finished_path, output_path)
+    os.remove(get_streaming_path(output_path))
+
+
+# Reads bands from an open dataset as float32 physical values, applying any scale/offset and turning nodata into NaN
+# Works for both the float32 and the scaled-integer profiles above (and uint16 mosaics made with keep_integers).
+# Integers only get turned into floats one read (e.g. one block) at a time, and the scale gets applied in place.
+def read_scaled(src, indexes, window=None):
+    data = src.read(indexes, window=window)
+    scaled = data.astype('float32', copy=False)
+    for i, index in enumerate(indexes):
+        nodata = src.nodatavals[index - 1]
+        if nodata is not None and not np.isnan(nodata):
+            scaled[i][data[i] == nodata] = np.nan
+        scale = src.scales[index - 1]
+        offset = src.offsets[index - 1]
+        if scale != 1:
+            scaled[i] *= np.float32(scale)
+        if offset != 0:
+            scaled[i] += np.float32(offset)
+    return scaled
@@ -0,0 +1,132 @@
+### Persistent, indexed catalog (SQLite) of every scene in a local L1 imagery directory
+### Stores each scene's item ID, acquisition time, satellite, CRS, footprint bounds, asset paths, size and checksum,
+### and only looks at files that are new or have changed since the last refresh
+### Used by make_mosaic.py and order_list_of_scenes.py
+
+
+
+# Import packages
+import datetime
+import os
+import sqlite3
+import rasterio
+from rasterio.warp import transform_bounds
+import build_manifest
+
+
+# File name endings for each asset of a scene; 3B is the code for the analytic SR data product
+sr_suffix = 'harmonized_clip.tif'
+udm2_suffix = '_3B_udm2_clip.tif'
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    item_id TEXT PRIMARY KEY,
+    acquired TEXT,
+    date TEXT,
+    satellite TEXT,
+    crs TEXT,
+    left REAL, bottom REAL, right REAL, top REAL,
+    lon_min REAL, lat_min REAL, lon_max REAL, lat_max REAL,
+    sr_path TEXT,
+    udm2_path TEXT,
+    xml_path TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_date ON scenes (date);
+CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (acquired);
+'''
+
+
+# Opens (and creates, if needed) a catalog
+def open_catalog(catalog_path):
+    conn = sqlite3.connect(catalog_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(schema)
+    return conn
+
+
+# Gets the item ID from any asset's file name, e.g. 20230628_182417_92_24a4 from 20230628_182417_92_24a4_3B_udm2_clip.tif
+def get_item_id(filename):
+    return filename.split('_3B')[0]
+
+
+# Works out acquisition time and satellite from an item ID
+# IDs look like <date>_<time>_<satellite> or <date>_<time>_<hundredths of a second>_<satellite>
+# Days composited by Planet at order time (see order_list_of_scenes.py) get the ID <date>_composite
+def parse_item_id(item_id):
+    parts = item_id.split('_')
+    if parts[1] == 'composite':
+        return datetime.datetime.strptime(parts[0], '%Y%m%d').isoformat(), parts[0], 'composite'
+    acquired = datetime.datetime.strptime(parts[0] + parts[1], '%Y%m%d%H%M%S')
+    if len(parts) == 4:
+        acquired += datetime.timedelta(seconds=int(parts[2]) / 100)
+    return acquired.isoformat(), parts[0], parts[-1]
+
+
+# Brings the catalog up to date with the imagery directory. The directory is listed once; scenes whose SR file has the
+# same size and modification time as last time are skipped, so only new or changed scenes get opened (and hashed).
+# Skipped scenes still get their UDM2 and XML paths updated if those files have turned up or gone away since.
+# compute_checksums: also store a sha256 of each SR file (slow for the first refresh of a big directory)
+def refresh_catalog(conn, imagery_directory, compute_checksums=False):
+    files_by_item = {}
+    for entry in os.scandir(imagery_directory):
+        if entry.is_file():
+            files_by_item.setdefault(get_item_id(entry.name), []).append(entry)
+
+    known = {row['item_id']: row for row in conn.execute('SELECT item_id, size, mtime, udm2_path, xml_path FROM scenes')}
+    num_added = 0
+    num_updated = 0
+    with conn:
+        for item_id, entries in files_by_item.items():
+            sr_entry = next((entry for entry in entries if entry.name.endswith(sr_suffix)), None)
+            if sr_entry is None:
+                continue
+            udm2_path = next((entry.path for entry in entries if entry.name.endswith(udm2_suffix)), None)
+            xml_path = next((entry.path for entry in entries if entry.name.endswith('.xml')), None)
+            stat = sr_entry.stat()
+            if item_id in known and known[item_id]['size'] == stat.st_size and known[item_id]['mtime'] == stat.st_mtime_ns:
+                if known[item_id]['udm2_path'] != udm2_path or known[item_id]['xml_path'] != xml_path:
+                    conn.execute('UPDATE scenes SET udm2_path = ?, xml_path = ? WHERE item_id = ?', (udm2_path, xml_path, item_id))
+                    num_updated += 1
+                continue
+            with rasterio.open(sr_entry.path) as src:
+                crs = src.crs.to_string()
+                bounds = src.bounds
+                lon_min, lat_min, lon_max, lat_max = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+            acquired, date, satellite = parse_item_id(item_id)
+            conn.execute(
+                'INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (item_id, acquired, date, satellite, crs,
+                 bounds.left, bounds.bottom, bounds.right, bounds.top,
+                 lon_min, lat_min, lon_max, lat_max,
+                 sr_entry.path,
+                 udm2_path,
+                 xml_path,
+                 stat.st_size, stat.st_mtime_ns,
+                 build_manifest.get_content_hash(sr_entry.path) if compute_checksums else None))
+            num_added += 1
+
+        # Forget scenes whose SR file is gone
+        removed = [item_id for item_id in known if not any(entry.name.endswith(sr_suffix) for entry in files_by_item.get(item_id, []))]
+        conn.executemany('DELETE FROM scenes WHERE item_id = ?', [(item_id,) for item_id in removed])
+
+    if num_added > 0 or num_updated > 0 or len(removed) > 0:
+        print('Scene catalog: ' + str(num_added) + ' new or changed scenes, ' + str(num_updated) + ' with new or missing UDM2/XML files, ' + str(len(removed)) + ' removed.')
+
+
+# Lists every date (YYYYMMDD) there are scenes for
+def get_dates(conn):
+    return [row['date'] for row in conn.execute('SELECT DISTINCT date FROM scenes ORDER BY date')]
+
+
+# Gets every scene acquired on a date (YYYYMMDD)
+def get_scenes_for_date(conn, date):
+    return list(conn.execute('SELECT * FROM scenes WHERE date = ? ORDER BY acquired', (date,)))
+
+
+# Checks whether a scene with this exact item ID has already been downloaded
+def has_item(conn, item_id):
+    return conn.execute('SELECT 1 FROM scenes WHERE item_id = ?', (item_id,)).fetchone() is not None
@@ -1,52 +1,71 @@
 ### Gets list of images that overlap with a given date, collects relevant metadata, and dumps it all to a csv
+### Can also search a whole directory (or list) of AOIs at once, e.g. every UCNRS reserve, with one result file per AOI
 
 
 
 geojson_path = 'E:/coal_oil_point/Coal_Oil_Point_Natural_Reserve.geojson'
 output_file = 'E:/coal_oil_point/copr_img_ids.csv'
 
-
-
+# Batch mode searches every AOI in a directory of GeoJSONs (or a list of GeoJSON paths) instead of just geojson_path.
+# Each AOI's results get saved to batch_output_directory as <AOI file name>_img_ids.csv (or .parquet, see
+# batch_output_format). Set to None to only search geojson_path. Can also be given on the command line with --aois.
+batch_aois = None       # e.g. '../basemaps/bounds/geojsons/UCNRS'
+batch_output_directory = 'E:/ucnrs/scene_searches'
+batch_output_format = 'csv'
+
+# Searches in batch mode run this many at a time, sharing one pooled connection to the API. Every request (from any
+# search) goes through one rate limiter, which spaces them out to at most requests_per_second and holds everything back
+# for as long as the API asks whenever it answers 429 Too Many Requests
+max_concurrent_searches = 8
+requests_per_second = 5
+max_retries = 5
+
+# AOIs with more vertices or bigger than this (as GeoJSON) get a 413 'Request Entity Too Large' from the API, so they're
+# simplified to fit before searching. The simplified AOI always covers the original one, so no scenes get missed.
+# Simplified AOIs get cached in simplified_aoi_directory (set to None to work them out again every run).
+max_aoi_vertices = 1500
+max_aoi_bytes = 100000
+simplified_aoi_directory = './simplified_aois'
+
+# Incremental mode remembers, for each AOI and set of search filters, the newest acquisition time and every item ID it
+# has saved so far (in search_state_path). The next search then only asks for items acquired since then, less
+# look_back_days to catch items that Planet publishes late, and adds whatever's new to the existing results file.
+# Changing the filters or the AOI starts over with a full search. Can be turned off for a run with --full.
+incremental = True
+search_state_path = './search_state.json'
+look_back_days = 7
+
+# Long searches can be split into date-range shards ('month' or 'quarter') that get searched side by side, up to
+# max_concurrent_shards at a time, instead of as one long chain of pages that each have to arrive before the next one
+# can be asked for. The shards' results get merged into one file, deduplicated by item ID and in acquisition order.
+# Full searches start at search_start_date. Set shard_by to None to search in one go (and stream results to disk).
+shard_by = None
+search_start_date = '2016-01-01'
+max_concurrent_shards = 4
+
+
+
+import argparse
+import datetime
 import requests
 import os
-import json
+import threading
 import pandas as pd
 import numpy as np
 import time
-from requests.auth import HTTPBasicAuth
+import aoi_geometry
+import build_manifest
+import instrumentation
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 
 # authentication
+# one session is shared by every search, with a connection pool big enough for all of them
 PLANET_API_KEY = os.getenv('PL_API_KEY')
-API_URL = "https://api.planet.com/basemaps/v1/mosaics"
 session = requests.Session()
 session.auth = (PLANET_API_KEY,'')
-
-
-# filter for items the overlap with our chosen geometry
-with open(geojson_path) as f:
-    geometry = json.load(f)
-
-geometry_filter = {
-    "type": "GeometryFilter",
-    "field_name": "geometry",
-    "config": {
-        "type": "Polygon",
-        "coordinates": geometry['features'][0]['geometry']['coordinates']
-    }
-}
-
-
-# # filter images acquired in a certain date range
-# # if a date range filter is added, make sure to add it to "big_filter" below
-# date_range_filter = {
-#   "type": "DateRangeFilter",
-#   "field_name": "acquired",
-#   "config": {
-#     "gte": "2016-01-01T00:00:00.000Z",
-#     "lte": "2017-01-01T00:00:00.000Z"
-#   }
-# }
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrent_searches * 2))
 
 
 # filter any images which are more than 50% clouds
@@ -67,139 +86,366 @@ type_filter = {
 }
 
 
-# mash 'em all together
-big_filter = {
-  "type": "AndFilter",
-  "config": [geometry_filter, type_filter, cloud_cover_filter]
-}
-
-
-
-# Search API request object
-search_endpoint_request = {
-  "item_types": ["PSScene"],
-  "filter": big_filter
-}
-
-# fire off the POST request
-print('Searching...')
-result = \
-  requests.post(
-    'https://api.planet.com/data/v1/quick-search',
-    auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''),
-    json=search_endpoint_request)
-print(result.status_code, result.reason)
+# Search API request object for an AOI
+# geometry: GeoJSON geometry (Polygon or MultiPolygon) of the AOI, e.g. from aoi_geometry.prepare_aoi
+# acquired_after, acquired_before: if given, only search for images acquired at or after / before these datetimes
+def get_search_request(geometry, acquired_after=None, acquired_before=None):
+    # filter for items the overlap with our chosen geometry
+    geometry_filter = {
+        "type": "GeometryFilter",
+        "field_name": "geometry",
+        "config": geometry
+    }
 
+    # mash 'em all together
+    big_filter = {
+      "type": "AndFilter",
+      "config": [geometry_filter, type_filter, cloud_cover_filter]
+    }
 
+    # filter images acquired in a certain date range
+    if acquired_after is not None or acquired_before is not None:
+        date_range_filter = {
+          "type": "DateRangeFilter",
+          "field_name": "acquired",
+          "config": {}
+        }
+        if acquired_after is not None:
+            date_range_filter['config']['gte'] = acquired_after.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        if acquired_before is not None:
+            date_range_filter['config']['lt'] = acquired_before.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        big_filter['config'].append(date_range_filter)
+
+    return {
+      "item_types": ["PSScene"],
+      "filter": big_filter
+    }
 
 
-# handling for 413 'Request Entity Too Large' HTTP error
-if result.status_code == 413:
-    while True:
-        print('A 413 error is usually caused by having too many points in the geometry.')
-        print('The existing geometry has ' + str(len(geometry['features'][0]['geometry']['coordinates'][0])) + ' points.')
-        print('Reducing detail in the geometry and trying again...')
-        
-        # removes every other point on the input geometry to reduce the size of the request body
-        # this will reduce the detail of the geometry, but it will still be roughly the same shape
-        all_points = geometry['features'][0]['geometry']['coordinates'][0]
-        new_points = []
-        for i in range(0, len(all_points), 2):
-            new_points.append(all_points[i])
-
-        geometry['features'][0]['geometry']['coordinates'][0] = new_points
-
-        geometry_filter = {
-            "type": "GeometryFilter",
-            "field_name": "geometry",
-            "config": {
-                "type": "Polygon",
-                "coordinates": geometry['features'][0]['geometry']['coordinates']
-            }
-        }
 
-        big_filter = {
-        "type": "AndFilter",
-        "config": [geometry_filter, type_filter, cloud_cover_filter]
-        }
-        search_endpoint_request = {
-        "item_types": ["PSScene"],
-        "filter": big_filter
-        }
-        result = \
-        requests.post(
-            'https://api.planet.com/data/v1/quick-search',
-            auth=HTTPBasicAuth(os.environ['PL_API_KEY'], ''),
-            json=search_endpoint_request)
-        print(result.status_code, result.reason)
-        if result.status_code != 413:
-            print("Request successful with " + str(len(geometry['features'][0]['geometry']['coordinates'][0])) + " points.")
-            break
-        if result.status_code == 413:
-            print("Reduced geometry still too large. Trying again...")
-            time.sleep(1)   ### this is a hacky way to avoid getting rate limited by the API
-            continue
+#### Rate limiting ####
+#### Shared by every thread; each request reserves the next free slot, so requests go out evenly spaced
 
+rate_lock = threading.Lock()
+next_request_time = 0.0     # earliest time (time.monotonic()) the next request is allowed to go out
 
 
-# stores all image ids in a list
-item_ids = []
-dates = []
-visible_percents = []
-ground_controls = []
-satellite_azimuths = []
+# waits until it's this request's turn
+def wait_for_rate_limit():
+    global next_request_time
+    with rate_lock:
+        now = time.monotonic()
+        wait = next_request_time - now
+        next_request_time = max(now, next_request_time) + 1 / requests_per_second
+    if wait > 0:
+        time.sleep(wait)
 
-print("Fetching results...")
-search_url = result.json()['_links']['_self']
 
+# holds back every request (from every thread) for a while, e.g. after a 429
+def back_off(seconds):
+    global next_request_time
+    with rate_lock:
+        next_request_time = max(next_request_time, time.monotonic() + seconds)
 
 
-# adds image ids to list of results
-def handle_page(page):
-    for item in page["features"]:
-        item_ids.append(item['id'])
-        dates.append(item['properties']['acquired'])
+# how long a 429 response asks us to wait; Retry-After can be a number of seconds or an HTTP date
+def get_retry_after(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
         try:
-            visible_percents.append(item['properties']['visible_percent'])
-        except:
-            visible_percents.append(np.NaN)
-        ground_controls.append(item['properties']['ground_control'])
-        satellite_azimuths.append(item['properties']['satellite_azimuth'])
+            return max(0, float(retry_after))
+        except ValueError:
+            try:
+                retry_time = datetime.datetime.strptime(retry_after, '%a, %d %b %Y %H:%M:%S GMT')
+                return max(0, (retry_time - datetime.datetime.utcnow()).total_seconds())
+            except ValueError:
+                pass
+    return 2 ** attempt
+
+
+# sends a request to the API through the rate limiter, retrying (after the wait the API asks for) on 429s
+# any other response, good or bad, gets returned as-is
+# body: JSON body to send, if any
+# endpoint, fields: recorded with the request's instrumentation span
+def send_request(method, url, endpoint, body=None, **fields):
+    for attempt in range(max_retries + 1):
+        wait_for_rate_limit()
+        with instrumentation.span('api_request', endpoint=endpoint, **fields) as s:
+            response = session.request(method, url, json=body)
+            s['status'] = response.status_code
+            s['bytes'] = len(response.content)
+        if response.status_code != 429 or attempt == max_retries:
+            return response
+        wait = get_retry_after(response, attempt)
+        print('Rate limited by the API; waiting ' + str(round(wait, 1)) + ' seconds...')
+        back_off(wait)
+
+
+
+#### Search ####
+
+# Results get streamed page by page straight into the output file, so memory use stays flat however many pages there are
+# The search asks for results sorted by acquisition time, so the output comes out in order without sorting it afterwards
+# An output_file ending in .parquet gets written as Parquet (needs pyarrow); anything else gets written as CSV
+columns = ['Image_IDs', 'Visible_Percent', 'Ground_Control', 'Satellite_Azimuth', 'Date', 'Time_UTC']
+
+
+# gets one page of results
+def fetch_page(search_url, page_number):
+    response = send_request('GET', search_url, 'search page', page=page_number)
+    response.raise_for_status()
+    return response.json()
 
 
 # pagination
-def fetch_page(search_url):
-    fetch_page.counter += 1
-    print("Working on page " + str(fetch_page.counter) + " of results...")
-    page = session.get(search_url).json()
-    handle_page(page)
-    next_url = page["_links"].get("_next")
-    if next_url:
-        fetch_page(next_url)
-
-# let's go!
-fetch_page.counter = 0
-fetch_page(search_url)
-
-# store img metadata in a dataframe
-outputs = {
-    'Image_IDs': item_ids,
-    'Datetime': dates,
-    'Visible_Percent': visible_percents,
-    'Ground_Control': ground_controls,
-    'Satellite_Azimuth': satellite_azimuths
-}
-print("Search complete. Saving results to disk...")
-df = pd.DataFrame(outputs)
-
-
-# some quick QOL adjustments...
-df['Date'] = df['Datetime'].str[:10]
-df['Time_UTC'] = df['Datetime'].str[11:-1]
-df = df.sort_values(by=['Datetime'])
-df = df.drop('Datetime', axis=1)
-
-
-# save outputs to csv
-df.to_csv(output_file, index=False)
-print("Done.")
\ No newline at end of file
+# yields every page of results in turn, starting from the page the search itself returned; the next page gets fetched in
+# the background while the current one is being written
+def iter_pages(first_page):
+    page = first_page
+    page_number = 1
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while page is not None:
+            next_url = page["_links"].get("_next")
+            next_page = executor.submit(fetch_page, next_url, page_number + 1) if next_url else None
+            yield page
+            page = next_page.result() if next_page is not None else None
+            page_number += 1
+
+
+# turns one page of results into a table with a row per image
+def page_to_table(page):
+    rows = []
+    for item in page["features"]:
+        properties = item['properties']
+        rows.append({
+            'Image_IDs': item['id'],
+            'Visible_Percent': properties.get('visible_percent', np.nan),
+            'Ground_Control': properties['ground_control'],
+            'Satellite_Azimuth': properties['satellite_azimuth'],
+            'Date': properties['acquired'][:10],
+            'Time_UTC': properties['acquired'][11:-1],
+        })
+    return pd.DataFrame(rows, columns=columns).astype({'Visible_Percent': 'float64', 'Ground_Control': 'bool', 'Satellite_Azimuth': 'float64'})
+
+
+# gets the acquisition time of each row of a results table back in the API's format, e.g. 2023-06-28T18:24:17.92Z
+def get_acquired(table):
+    return table['Date'] + 'T' + table['Time_UTC'] + 'Z'
+
+
+# writes every page to the output file as it arrives; the file is written under a temporary name and only moved into
+# place once the last page is in, so an interrupted search never leaves a partial result behind
+# returns the IDs of the images written and the latest acquisition time among them (None if there weren't any)
+# label: printed with each page's progress message, so concurrent searches can be told apart
+def write_pages(pages, output_path, label=''):
+    temp_path = output_path + '.tmp'
+    parquet_writer = None
+    item_ids = []
+    latest = None
+    try:
+        for page_number, page in enumerate(pages):
+            print(label + "Working on page " + str(page_number + 1) + " of results...")
+            table = page_to_table(page)
+            with instrumentation.span('write', rows=len(table)):
+                if output_path.endswith('.parquet'):
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                    if parquet_writer is None:
+                        schema = pa.schema([('Image_IDs', pa.string()), ('Visible_Percent', pa.float64()), ('Ground_Control', pa.bool_()),
+                                            ('Satellite_Azimuth', pa.float64()), ('Date', pa.string()), ('Time_UTC', pa.string())])
+                        parquet_writer = pq.ParquetWriter(temp_path, schema)
+                    parquet_writer.write_table(pa.Table.from_pandas(table, schema=schema, preserve_index=False))
+                else:
+                    table.to_csv(temp_path, mode='w' if page_number == 0 else 'a', header=page_number == 0, index=False)
+            item_ids.extend(table['Image_IDs'])
+            if len(table) > 0:
+                latest = max(filter(None, [latest, get_acquired(table).max()]))
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+    os.replace(temp_path, output_path)
+    return item_ids, latest
+
+
+# reads a results file written by write_pages
+def read_results(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype={'Image_IDs': str, 'Date': str, 'Time_UTC': str})
+
+
+# writes a whole results table at once, under a temporary name that gets moved into place when it's done
+def write_results(table, output_path):
+    with instrumentation.span('write', rows=len(table)):
+        if output_path.endswith('.parquet'):
+            table.to_parquet(output_path + '.tmp', index=False)
+        else:
+            table.to_csv(output_path + '.tmp', index=False)
+    os.replace(output_path + '.tmp', output_path)
+
+
+# adds new rows to an existing results file, keeping it free of duplicates and in order of acquisition time
+def merge_results(new_table, output_path):
+    table = pd.concat([read_results(output_path), new_table], ignore_index=True)
+    write_results(table.drop_duplicates(subset='Image_IDs', keep='last').sort_values(by=['Date', 'Time_UTC']), output_path)
+
+
+# fires off the search for an AOI and returns the first page of results
+def quick_search(geometry, label='', acquired_after=None, acquired_before=None):
+    print(label + 'Searching...')
+    result = send_request('POST', 'https://api.planet.com/data/v1/quick-search?_sort=acquired%20asc', 'quick-search', body=get_search_request(geometry, acquired_after, acquired_before))
+    print(label + str(result.status_code) + ' ' + result.reason)
+    if result.status_code == 413:
+        print(label + "The AOI is still too big for the API; try lowering max_aoi_vertices or max_aoi_bytes.")
+    result.raise_for_status()
+    return result.json()
+
+
+# splits the time from start until now into shards that line up with calendar months or quarters (see shard_by)
+# returns a list of (start, end) datetimes; the last shard has no end, so it also catches anything published mid-search
+def get_shards(start):
+    months_per_shard = 3 if shard_by == 'quarter' else 1
+    now = datetime.datetime.utcnow()
+    shards = []
+    shard_start = start
+    while True:
+        month_index = (shard_start.year * 12 + shard_start.month - 1) // months_per_shard * months_per_shard + months_per_shard
+        shard_end = datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+        if shard_end > now:
+            shards.append((shard_start, None))
+            return shards
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+
+
+# searches one shard and returns all of its results as one table
+def search_shard(geometry, label, shard_start, shard_end):
+    first_page = quick_search(geometry, label, acquired_after=shard_start, acquired_before=shard_end)
+    return pd.concat([page_to_table(page) for page in iter_pages(first_page)], ignore_index=True)
+
+
+# searches everything acquired since start, split into shards that run max_concurrent_shards at a time
+# returns one table of every result, deduplicated by item ID and in order of acquisition time
+def search_sharded(geometry, label='', start=None):
+    start = start or datetime.datetime.strptime(search_start_date, '%Y-%m-%d')
+    shards = get_shards(start)
+    print(label + 'Searching ' + str(len(shards)) + ' ' + shard_by + 's, ' + str(max_concurrent_shards) + ' at a time...')
+    with ThreadPoolExecutor(max_workers=max_concurrent_shards) as executor:
+        futures = [executor.submit(search_shard, geometry, label + '[' + shard_start.strftime('%Y-%m') + '] ', shard_start, shard_end) for shard_start, shard_end in shards]
+        tables = [future.result() for future in futures]
+    table = pd.concat(tables, ignore_index=True)
+    return table.drop_duplicates(subset='Image_IDs').sort_values(by=['Date', 'Time_UTC'])
+
+
+#### Incremental search state ####
+#### Looks like {'outputs': {'<AOI name>/<filter hash>': {'output': results path, 'high_water_mark': latest acquired,
+#### 'item_ids': [...]}}}, and gets saved the same way as a build manifest. Shared by every thread in batch mode.
+
+search_state = None
+state_lock = threading.Lock()
+
+
+def get_search_state():
+    global search_state
+    with state_lock:
+        if search_state is None:
+            search_state = build_manifest.load_manifest(search_state_path)
+        return search_state
+
+
+def record_search(state_key, output_path, item_ids, latest):
+    with state_lock:
+        search_state['outputs'][state_key] = {'output': os.path.abspath(output_path), 'high_water_mark': latest, 'item_ids': item_ids}
+        build_manifest.save_manifest(search_state, search_state_path)
+
+
+# searches one AOI and saves the results to output_path; returns the number of images found
+# In incremental mode, AOIs that have been searched before (with the same filters, into the same file) only get
+# searched for images acquired since the last search, and only the new images get added to the results
+def search_aoi(aoi_path, output_path, label=''):
+    geometry = aoi_geometry.prepare_aoi(aoi_path, max_aoi_vertices, max_aoi_bytes, simplified_aoi_directory)
+    state_key = os.path.splitext(os.path.basename(aoi_path))[0] + '/' + build_manifest.get_definition_version(get_search_request(geometry))
+    previous = get_search_state()['outputs'].get(state_key)
+    if not incremental or previous is None or previous['high_water_mark'] is None or previous['output'] != os.path.abspath(output_path) or not os.path.exists(output_path):
+        if shard_by is not None:
+            table = search_sharded(geometry, label)
+            write_results(table, output_path)
+            item_ids = list(table['Image_IDs'])
+            latest = get_acquired(table).max() if len(table) > 0 else None
+        else:
+            first_page = quick_search(geometry, label)
+            print(label + "Fetching results and saving them to disk...")
+            item_ids, latest = write_pages(iter_pages(first_page), output_path, label)
+        record_search(state_key, output_path, item_ids, latest)
+        return len(item_ids)
+
+    since = datetime.datetime.strptime(previous['high_water_mark'][:19], '%Y-%m-%dT%H:%M:%S') - datetime.timedelta(days=look_back_days)
+    known_ids = set(previous['item_ids'])
+    if shard_by is not None:
+        new_table = search_sharded(geometry, label, since)
+    else:
+        first_page = quick_search(geometry, label, acquired_after=since)
+        new_table = pd.concat([page_to_table(page) for page in iter_pages(first_page)], ignore_index=True)
+    new_table = new_table[~new_table['Image_IDs'].isin(known_ids)]
+    print(label + 'Found ' + str(len(new_table)) + ' new images acquired since ' + since.strftime('%Y-%m-%d') + '.')
+    if len(new_table) > 0:
+        merge_results(new_table, output_path)
+        latest = max(previous['high_water_mark'], get_acquired(new_table).max())
+        record_search(state_key, output_path, previous['item_ids'] + list(new_table['Image_IDs']), latest)
+    return len(new_table)
+
+
+# lists the AOIs to search in batch mode: every .geojson in a directory, or a list of paths as-is
+def get_batch_aois(aois):
+    if isinstance(aois, str):
+        return sorted([os.path.join(aois, file) for file in os.listdir(aois) if file.endswith('.geojson')])
+    return list(aois)
+
+
+# searches every AOI, max_concurrent_searches at a time, with one result file per AOI
+# a failed search gets reported but doesn't stop the others
+def search_batch(aoi_paths, output_directory):
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    print('Searching ' + str(len(aoi_paths)) + ' AOIs, ' + str(max_concurrent_searches) + ' at a time...')
+    failures = []
+    with ThreadPoolExecutor(max_workers=max_concurrent_searches) as executor:
+        futures = {}
+        for aoi_path in aoi_paths:
+            name = os.path.splitext(os.path.basename(aoi_path))[0]
+            output_path = os.path.join(output_directory, name + '_img_ids.' + batch_output_format)
+            futures[executor.submit(search_aoi, aoi_path, output_path, '[' + name + '] ')] = name
+        for count, future in enumerate(as_completed(futures)):
+            name = futures[future]
+            try:
+                num_images = future.result()
+                print(str(datetime.datetime.now().time()) + '    Finished ' + name + ': ' + str(num_images) + (' new' if incremental else '') + ' images (' + str(count+1) + ' of ' + str(len(futures)) + ')')
+            except Exception as e:
+                print(str(datetime.datetime.now().time()) + '    Search failed for ' + name + ': ' + repr(e))
+                failures.append(name)
+    if len(failures) > 0:
+        print(str(len(failures)) + ' searches failed: ' + ', '.join(sorted(failures)))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Searches for PlanetScope scenes over one AOI, or a whole directory of AOIs at once')
+    parser.add_argument('--aois', nargs='+', default=None, help='directory of GeoJSONs, or a list of GeoJSON files, to search in batch mode')
+    parser.add_argument('--output-directory', default=batch_output_directory, help='directory to save batch mode results to')
+    parser.add_argument('--full', action='store_true', help='search the whole history again instead of just what is new since the last search')
+    parser.add_argument('--shard-by', choices=['month', 'quarter'], default=shard_by, help='split the search into date ranges that run side by side')
+    args = parser.parse_args()
+    if args.full:
+        incremental = False
+    shard_by = args.shard_by
+
+    aois = batch_aois
+    if args.aois is not None:
+        aois = args.aois[0] if len(args.aois) == 1 and os.path.isdir(args.aois[0]) else args.aois
+
+    # let's go!
+    if aois is None:
+        num_images = search_aoi(geojson_path, output_file)
+        print("Done. Found " + str(num_images) + (" new" if incremental else "") + " images.")
+    else:
+        search_batch(get_batch_aois(aois), args.output_directory)